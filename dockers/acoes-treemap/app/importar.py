@@ -0,0 +1,280 @@
+"""Importacao em lote do historico de negociacoes (B3/corretora).
+
+Le o arquivo em blocos, sem carrega-lo inteiro na memoria, e calcula
+quantidade e preco medio ponderado de forma incremental (vendas reduzem a
+quantidade sem alterar o medio; zerar a posicao zera o medio).
+
+O progresso fica em `importacao.json`: posicao em bytes ja processada de cada
+arquivo e as posicoes acumuladas. Reimportar o mesmo arquivo com novas linhas
+no final processa apenas as linhas novas.
+
+Uso:
+    python importar.py negociacoes.csv
+    python importar.py negociacoes.csv --refazer   # descarta o progresso e recalcula
+"""
+import argparse
+import codecs
+import hashlib
+import io
+import json
+import os
+import unicodedata
+
+import pandas as pd
+
+STATE_FILE = 'importacao.json'
+CHUNK_ROWS = 5000
+
+# Campos usados no calculo; as demais colunas do extrato nem sao lidas
+TRADE_FIELDS = ('date', 'side', 'ticker', 'qty', 'price')
+
+# Nomes de coluna aceitos (sem acento, minusculos) -> campo interno
+COLUMN_ALIASES = {
+    'data do negocio': 'date', 'data': 'date', 'date': 'date',
+    'tipo de movimentacao': 'side', 'compra/venda': 'side', 'c/v': 'side', 'tipo': 'side', 'side': 'side',
+    'codigo de negociacao': 'ticker', 'codigo': 'ticker', 'ativo': 'ticker', 'ticker': 'ticker',
+    'quantidade': 'qty', 'qtd': 'qty', 'quantity': 'qty',
+    'preco': 'price', 'preco unitario': 'price', 'price': 'price'
+}
+
+BUY_VALUES = {'compra', 'c', 'buy'}
+SELL_VALUES = {'venda', 'v', 'sell'}
+
+
+class TradeFileError(Exception):
+    """Arquivo invalido ou alterado fora do final desde a ultima importacao"""
+
+
+def _normalize(name):
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    return name.strip().lower()
+
+
+def _to_number(series, brazilian=False):
+    """Converte '1.234,56', 'R$ 10,50' ou '10.5' em float; com `brazilian`, '1.000' vale mil"""
+    text = series.astype(str).str.replace('R$', '', regex=False).str.strip()
+    if brazilian:
+        return pd.to_numeric(text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False), errors='coerce')
+    brazilian = text.str.contains(',', regex=False)
+    text = text.where(~brazilian, text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(text, errors='coerce')
+
+
+def _detect_encoding(f, size=65536):
+    """utf-8 (com ou sem BOM) se o inicio do arquivo decodifica; senao cp1252, padrao dos extratos da B3/corretoras"""
+    sample = f.read(size)
+    f.seek(0)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp1252'
+
+
+def _tail_hash(f, offset, size=1024):
+    """Hash dos ultimos bytes ja processados, para detectar se o arquivo foi so acrescido"""
+    f.seek(max(0, offset - size))
+    return hashlib.sha1(f.read(offset - max(0, offset - size))).hexdigest()
+
+
+def load_state(path=STATE_FILE):
+    if not os.path.exists(path):
+        return {'files': {}, 'positions': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_FILE):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+def apply_trades(positions, chunk):
+    """Atualiza {ticker: [quantidade, preco_medio]} com as negociacoes do bloco, em ordem"""
+    warnings = []
+    for ticker, side, qty, price in zip(chunk['ticker'], chunk['side'], chunk['qty'], chunk['price']):
+        shares, avg = positions.get(ticker, (0.0, 0.0))
+        if side in BUY_VALUES:
+            total = shares + qty
+            avg = (shares * avg + qty * price) / total if total > 0 else 0.0
+            shares = total
+        elif side in SELL_VALUES:
+            if qty > shares:
+                warnings.append(f'{ticker}: venda de {qty:g} maior que a posicao ({shares:g})')
+                qty = shares
+            shares -= qty
+            if shares == 0:
+                avg = 0.0
+        else:
+            warnings.append(f'{ticker}: tipo de movimentacao desconhecido "{side}"')
+            continue
+        positions[ticker] = [shares, avg]
+    return warnings
+
+
+def _to_date(series):
+    """Datas do extrato: dd/mm/aaaa (B3/corretoras) ou ISO (aaaa-mm-dd)"""
+    values = series.dropna()
+    iso = len(values) > 0 and values.iloc[0].strip()[:4].isdigit()
+    return pd.to_datetime(series, format='ISO8601' if iso else None, dayfirst=not iso, errors='coerce')
+
+
+def _blocks(f, start, end):
+    """Divide o arquivo entre `start` e `end` em blocos de CHUNK_ROWS linhas: (posicao inicial, bytes)"""
+    f.seek(start)
+    while start < end:
+        lines = []
+        while len(lines) < CHUNK_ROWS:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+        if not lines:
+            break
+        data = b''.join(lines)
+        yield start, data
+        start += len(data)
+
+
+def _parse_trades(data, sep, columns, encoding, brazilian):
+    """Bloco de linhas do extrato -> DataFrame normalizado (ticker, tipo, quantidade, preco e data)"""
+    usecols = {columns.index(field): field for field in TRADE_FIELDS if field in columns}
+    chunk = pd.read_csv(io.BytesIO(data), sep=sep, header=None, usecols=list(usecols), dtype=str,
+                        encoding=encoding, skip_blank_lines=True).rename(columns=usecols)
+    chunk = chunk.dropna(subset=['ticker'])
+    # Codigos do mercado fracionario (PETR4F) somam na mesma posicao
+    chunk['ticker'] = chunk['ticker'].str.strip().str.upper().str.replace(r'F$', '', regex=True)
+    chunk['side'] = chunk['side'].map(_normalize)
+    chunk['qty'] = _to_number(chunk['qty'], brazilian).fillna(0)
+    chunk['price'] = _to_number(chunk['price'], brazilian).fillna(0)
+    if 'date' in chunk:
+        chunk['date'] = _to_date(chunk['date'])
+    return chunk
+
+
+def import_trades(path, state_path=STATE_FILE, encoding=None, reset=False):
+    """Processa as linhas novas de `path` e retorna (posicoes acumuladas, resumo); sem `encoding`, detecta"""
+    state = {'files': {}, 'positions': {}} if reset else load_state(state_path)
+    key = os.path.abspath(path)
+    progress = state['files'].get(key)
+
+    with open(path, 'rb') as f:
+        encoding = encoding or _detect_encoding(f)
+        header_line = f.readline()
+        try:
+            header_text = header_line.decode(encoding)
+        except UnicodeDecodeError:
+            raise TradeFileError(f'Cabecalho ilegivel na codificacao {encoding} (tente cp1252)')
+        sep = ';' if header_text.count(';') > header_text.count(',') else ','
+        # Separador ';' = planilha pt-BR: ponto e sempre separador de milhar ('1.000' = mil acoes)
+        brazilian = sep == ';'
+        columns = [COLUMN_ALIASES.get(_normalize(c), _normalize(c)) for c in header_text.strip().split(sep)]
+        missing = {'side', 'ticker', 'qty', 'price'} - set(columns)
+        if missing:
+            raise TradeFileError(f"Colunas nao encontradas: {', '.join(sorted(missing))}")
+
+        size = os.fstat(f.fileno()).st_size
+        offset = len(header_line)
+        if progress:
+            if progress['offset'] > size or _tail_hash(f, progress['offset']) != progress['tail_hash']:
+                raise TradeFileError('Arquivo alterado desde a ultima importacao (use --refazer)')
+            offset = progress['offset']
+
+        positions = {t: list(v) for t, v in state['positions'].items()}
+        rows = 0
+        warnings = []
+        last_date = pd.Timestamp(progress['last_date']) if progress and progress.get('last_date') else None
+        parse = lambda data: _parse_trades(data, sep, columns, encoding, brazilian)
+        try:
+            # Primeira passada: aplica enquanto o arquivo estiver em ordem cronologica e guarda onde cada
+            # bloco comeca, para reler na ordem inversa se ele for do mais recente para o mais antigo
+            starts = []
+            ascending = descending = True
+            previous = last_date
+            for start, data in _blocks(f, offset, size):
+                starts.append(start)
+                chunk = parse(data)
+                dates = chunk['date'].dropna() if 'date' in chunk else pd.Series(dtype='datetime64[ns]')
+                if len(dates):
+                    ascending &= dates.is_monotonic_increasing and (previous is None or dates.iloc[0] >= previous)
+                    descending &= dates.is_monotonic_decreasing and (previous is None or dates.iloc[0] <= previous)
+                    previous = dates.iloc[-1]
+                    last_date = max(last_date, dates.max()) if last_date is not None else dates.max()
+                if ascending:
+                    warnings.extend(apply_trades(positions, chunk))
+                    rows += len(chunk)
+                elif progress:
+                    # Linhas novas mais antigas que as ja importadas: o preco medio salvo estaria errado
+                    raise TradeFileError('Negociacoes novas anteriores as ja importadas (use --refazer)')
+
+            if not ascending:
+                positions = {t: list(v) for t, v in state['positions'].items()}
+                warnings, rows = [], 0
+                if descending:
+                    # Extrato da B3 (mais recente primeiro): blocos e linhas na ordem inversa, um bloco por vez
+                    for start, end in reversed(list(zip(starts, starts[1:] + [size]))):
+                        f.seek(start)
+                        chunk = parse(f.read(end - start)).iloc[::-1]
+                        warnings.extend(apply_trades(positions, chunk))
+                        rows += len(chunk)
+                else:
+                    # Sem ordem nenhuma: so aqui o arquivo inteiro (apenas as colunas usadas) vai para a memoria
+                    trades = pd.concat([parse(data) for _, data in _blocks(f, offset, size)], ignore_index=True)
+                    trades = trades.sort_values('date', kind='stable', na_position='last')
+                    warnings = ['Arquivo fora de ordem cronologica: negociacoes ordenadas por data']
+                    warnings.extend(apply_trades(positions, trades))
+                    rows = len(trades)
+        except (UnicodeDecodeError, pd.errors.ParserError) as e:
+            raise TradeFileError(f'Arquivo ilegivel (codificacao {encoding}): {e}')
+
+        state['positions'] = positions
+        state['files'][key] = {
+            'offset': size,
+            'tail_hash': _tail_hash(f, size),
+            'rows': (progress['rows'] if progress else 0) + rows,
+            'last_date': last_date.isoformat() if last_date is not None else None
+        }
+
+    save_state(state, state_path)
+    return positions, {'rows': rows, 'tickers': len(positions), 'warnings': list(dict.fromkeys(warnings))}
+
+
+def merge_positions(stocks_df, positions):
+    """Substitui no DataFrame da carteira os tickers importados (posicoes zeradas saem)"""
+    imported = {f'{t}.SA' if not t.endswith('.SA') else t: v for t, v in positions.items()}
+    kept = stocks_df[~stocks_df['ticker'].isin(imported.keys())]
+    new_rows = pd.DataFrame(
+        [{'ticker': t, 'shares': int(round(s)), 'avg_price': round(a, 4)} for t, (s, a) in imported.items() if s > 0],
+        columns=['ticker', 'shares', 'avg_price']
+    )
+    return pd.concat([kept, new_rows], ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Importa o historico de negociacoes para acoes.csv')
+    parser.add_argument('arquivo', help='CSV exportado da B3/corretora')
+    parser.add_argument('--carteira', default='acoes.csv', help='arquivo da carteira (padrao: acoes.csv)')
+    parser.add_argument('--encoding', default=None, help='padrao: detecta (utf-8 ou cp1252)')
+    parser.add_argument('--refazer', action='store_true', help='descarta o progresso salvo e processa tudo')
+    args = parser.parse_args()
+
+    try:
+        positions, summary = import_trades(args.arquivo, encoding=args.encoding, reset=args.refazer)
+    except TradeFileError as e:
+        raise SystemExit(f'Erro: {e}')
+
+    try:
+        stocks_df = pd.read_csv(args.carteira)
+    except FileNotFoundError:
+        stocks_df = pd.DataFrame(columns=['ticker', 'shares', 'avg_price'])
+    merge_positions(stocks_df, positions).to_csv(args.carteira, index=False)
+
+    for warning in summary['warnings']:
+        print(f'Aviso: {warning}')
+    print(f"{summary['rows']} negociacoes novas processadas, {summary['tickers']} tickers na importacao")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Gerenciador local para os callbacks em segundo plano (background=True) do Dash.
+
+O DiskcacheManager do Dash roda cada job em um subprocesso, que nao enxerga o
+limitador de requisicoes, o circuit breaker nem os caches em memoria do
+main.py. Este gerenciador roda os jobs em um pool de threads do proprio
+processo e guarda os resultados em memoria, sem dependencias extras.
+
+Cancelar um job que ainda esta na fila impede que ele rode; um job ja em
+execucao termina a chamada atual, mas o resultado e descartado.
+
+Usa modulos internos do Dash (versao fixada em requirements.txt), os mesmos
+que o DiskcacheManager usa.
+"""
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from dash.exceptions import PreventUpdate
+from dash.long_callback.managers import BaseLongCallbackManager
+from dash.long_callback._proxy_set_props import ProxySetProps
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+
+
+class ThreadJobManager(BaseLongCallbackManager):
+    """Executa callbacks em segundo plano em threads, com resultado por job"""
+
+    # Resultados nao buscados (navegador fechado no meio do job) sao descartados apos esse tempo
+    RESULT_TTL = 300
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dash-job')
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.keys = {}
+        self.results = {}
+        self.finished = {}
+        self.progress = {}
+        self.props = {}
+        super().__init__(None)
+
+    def terminate_job(self, job):
+        if job is None:
+            return
+        job = str(job)
+        with self.lock:
+            future = self.jobs.pop(job, None)
+            self.keys.pop(job, None)
+            self.results.pop(job, None)
+            self.finished.pop(job, None)
+        if future is not None:
+            future.cancel()
+
+    def terminate_unhealthy_job(self, job):
+        return False
+
+    def job_running(self, job):
+        with self.lock:
+            future = self.jobs.get(str(job))
+        return future is not None and not future.done()
+
+    def make_job_fn(self, fn, progress, key=None):
+        def job_fn(job, result_key, user_callback_args, context):
+            def _set_progress(progress_value):
+                if not isinstance(progress_value, (list, tuple)):
+                    progress_value = [progress_value]
+                with self.lock:
+                    self.progress[result_key] = progress_value
+
+            def _set_props(_id, props):
+                with self.lock:
+                    self.props[result_key] = {_id: props}
+
+            maybe_progress = [_set_progress] if progress else []
+
+            def run():
+                c = AttributeDict(**context)
+                c.ignore_register_page = False
+                c.updated_props = ProxySetProps(_set_props)
+                context_value.set(c)
+                try:
+                    if isinstance(user_callback_args, dict):
+                        return fn(*maybe_progress, **user_callback_args)
+                    if isinstance(user_callback_args, (list, tuple)):
+                        return fn(*maybe_progress, *user_callback_args)
+                    return fn(*maybe_progress, user_callback_args)
+                except PreventUpdate:
+                    return {'_dash_no_update': '_dash_no_update'}
+                except Exception as err:  # pylint: disable=broad-except
+                    return {'long_callback_error': {'msg': str(err), 'tb': traceback.format_exc()}}
+
+            output = copy_context().run(run)
+            with self.lock:
+                # Job cancelado enquanto rodava: descarta o resultado
+                if job in self.jobs:
+                    self.results[job] = output
+                    self.finished[job] = time.monotonic()
+
+        return job_fn
+
+    def call_job_fn(self, key, job_fn, args, context):
+        job = str(next(self.ids))
+        now = time.monotonic()
+        with self.lock:
+            for old in [j for j, t in self.finished.items() if now - t > self.RESULT_TTL]:
+                self.jobs.pop(old, None)
+                self.keys.pop(old, None)
+                self.results.pop(old, None)
+                self.finished.pop(old, None)
+            self.keys[job] = key
+            self.jobs[job] = self.executor.submit(job_fn, job, key, args, context)
+        return job
+
+    def get_progress(self, key):
+        with self.lock:
+            return self.progress.pop(key, None)
+
+    def result_ready(self, key):
+        with self.lock:
+            return any(self.keys.get(job) == key for job in self.results)
+
+    def get_result(self, key, job):
+        job = str(job)
+        with self.lock:
+            if job not in self.results:
+                return self.UNDEFINED
+            result = self.results.pop(job)
+            self.progress.pop(key, None)
+        self.terminate_job(job)
+        return result
+
+    def get_updated_props(self, key):
+        with self.lock:
+            return self.props.pop(key, {})
@@ -1,16 +1,45 @@
 import dash
 from dash import dcc, html, dash_table
+from flask import request, Response, g, has_request_context, send_file, abort
+from flask_compress import Compress
 from dash.dependencies import Input, Output, State
 from dash import callback_context
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import pandas as pd
+import numpy as np
 import yfinance as yf
+from curl_cffi import requests as curl_requests
+from curl_cffi import CurlInfo
 from datetime import datetime
 import dash_bootstrap_components as dbc
 from collections import deque
-
-
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.DARKLY], suppress_callback_exceptions=True)
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import json
+import os
+import functools
+import cProfile
+import pstats
+import io
+import hmac
+import hashlib
+import tempfile
+from importar import import_trades, merge_positions, TradeFileError
+from jobs import ThreadJobManager
+
+
+# Callbacks em segundo plano (grafico historico) rodam em threads locais, sem prender o worker da requisicao
+job_manager = ThreadJobManager(max_workers=4)
+
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.DARKLY], suppress_callback_exceptions=True,
+                background_callback_manager=job_manager)
+
+# Respostas comprimidas com brotli ou gzip (o que o navegador aceitar); brotli em nivel baixo para poupar CPU
+app.server.config.update(COMPRESS_ALGORITHM=['br', 'gzip'], COMPRESS_BR_LEVEL=4, COMPRESS_LEVEL=6)
+Compress(app.server)
 
 # Fila para armazenar logs (max 50 entradas)
 log_queue = deque(maxlen=50)
@@ -19,21 +48,355 @@ log_queue = deque(maxlen=50)
 DEFAULT_TIMES = {
     'daily': 20,
     'weekly': 10,
-    'monthly': 10
+    'monthly': 10,
+    'risk': 10,
+    'market': 20
 }
 
 DEFAULT_ENABLED = {
     'daily': True,
     'weekly': True,
-    'monthly': True
+    'monthly': True,
+    'risk': False,
+    'market': False
 }
 
+# Escala de cores do treemap (mesma do Plotly), usada tambem no modo quiosque
+TREEMAP_COLORSCALE = [
+    [0.0, '#b71c1c'],
+    [0.4, '#d32f2f'],
+    [0.48, '#f44336'],
+    [0.5, '#546e7a'],
+    [0.52, '#66bb6a'],
+    [0.6, '#43a047'],
+    [1.0, '#1b5e20']
+]
+
+# Periodos do grafico historico: (titulo, validade do cache em segundos)
+HIST_RANGES = {
+    '1mo': ('Ultimos 30 Dias', 300),
+    '1y': ('Ultimo Ano', 3600),
+    '5y': ('Ultimos 5 Anos', 6 * 3600),
+    'max': ('Historico Completo', 12 * 3600)
+}
+
+# Maximo de pontos enviados ao grafico (aprox. largura em pixels do modal)
+HIST_MAX_POINTS = 700
+
+# Cache do historico: (ticker, periodo) -> (instante da busca, serie de fechamento)
+hist_cache = {}
+hist_cache_lock = threading.Lock()
+
+# Historico de valor da carteira: registros brutos (so acrescimo) e agregados diarios
+HISTORY_FILE = 'historico.csv'
+DAILY_HISTORY_FILE = 'historico_diario.json'
+history_lock = threading.Lock()
+daily_history = {'loaded': False, 'offset': 0, 'days': {}}
+
+# Matriz de fechamentos diarios (1 ano) usada na tela de risco, renovada uma vez por dia
+PRICE_MATRIX_FILE = 'precos_diarios.csv'
+price_matrix = {'df': None, 'date': None}
+price_matrix_lock = threading.Lock()
+
+# Correlacao e risco calculados uma vez por versao do snapshot
+risk_cache = {'version': None, 'result': None, 'running': False}
+risk_lock = threading.Lock()
+
+# Mapa do mercado: universo de tickers (mercado.csv), buscado em lotes nos endpoints de cotacao
+# (preco, variacao do dia e valor de mercado) e de fechamentos diarios (variacao de 7 dias) do Yahoo
+MARKET_FILE = 'mercado.csv'
+MARKET_QUOTE_URL = 'https://query1.finance.yahoo.com/v7/finance/quote'
+MARKET_SPARK_URL = 'https://query1.finance.yahoo.com/v8/finance/spark'
+MARKET_BATCH = 50
+MARKET_SPARK_BATCH = 20
+
+# Cotacoes do mercado em colunas float32, uma linha por ticker (posicao em market['index'])
+MARKET_COLUMNS = ('price', 'change_pct_day', 'change_pct_7days', 'market_cap')
+market = {'tickers': [], 'index': {}, 'quotes': None, 'fetched': 0.0, 'updated': None, 'version': 0, 'running': False}
+market_lock = threading.Lock()
+# Figuras do mapa do mercado ja montadas: (versao do mercado, tela) -> figura
+market_figures = {}
+
+# Callbacks mais lentos que isso (ms) aparecem no /logs com o detalhamento do tempo
+SLOW_CALLBACK_MS = int(os.environ.get('SLOW_CALLBACK_MS', 500))
+
+# Token do endpoint /debug/profile (vazio desabilita o endpoint)
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_FILE = os.path.join(tempfile.gettempdir(), 'acoes-callbacks.prof')
+PROFILE_REFRESH_FILE = os.path.join(tempfile.gettempdir(), 'acoes-refresh.prof')
+# 'upstream': lista que recebe os perfis das threads do pool do Yahoo enquanto ?refresh=1 roda
+profiling = {'profiler': None, 'remaining': 0, 'total': 0, 'ready': False, 'upstream': None}
+profile_lock = threading.Lock()
+
+# Linhas por pagina na tabela de acoes (paginacao no servidor)
+STOCKS_PAGE_SIZE = 25
+
+# Snapshot de cotacoes compartilhado por todos os clientes (uma busca por intervalo, nao por navegador)
+SNAPSHOT_TTL = 290
+SNAPSHOT_COLUMNS = ['ticker', 'price', 'avg_price', 'change_pct_day', 'change_value_day', 'change_pct_7days',
+                    'change_value_7days', 'change_pct_total', 'change_value_total', 'shares', 'value', 'participation']
+snapshot = {'df': None, 'fetched': 0.0, 'updated': None, 'version': 0, 'stale': False,
+            'running': False, 'invalidated': False}
+snapshot_lock = threading.Lock()
+
+# Intervalo de consulta do navegador (ms): curto enquanto a primeira busca nao termina
+FETCH_POLL_MS = 30000
+FETCH_WAIT_MS = 2000
+
+# Paginas do modo quiosque ja renderizadas para o snapshot atual: chave -> (html, etag)
+kiosk_cache = {}
+kiosk_cache_lock = threading.Lock()
+
+# Figuras do treemap ja montadas para o snapshot atual: (snapshot, tela) -> figura
+figure_cache = {}
+figure_cache_lock = threading.Lock()
+
+# Assets com ?m=<data de modificacao> na URL podem ficar em cache no navegador por 1 ano
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# Limite global de chamadas ao Yahoo (requisicoes por segundo e rajada maxima)
+UPSTREAM_RATE = 2.0
+UPSTREAM_BURST = 5
+
+# O mapa do mercado usa no maximo 1/4 do limite global (alem de consumir o global) e renova a cada 10 min,
+# para nao atrasar as cotacoes da carteira
+MARKET_RATE = 0.5
+MARKET_BURST = 2
+MARKET_TTL = 600
+
+# Conexoes com o Yahoo: threads fixas (o curl_cffi guarda uma conexao keep-alive por thread)
+# e cookie/crumb renovados periodicamente
+UPSTREAM_POOL_SIZE = 4
+CRUMB_MAX_AGE = 6 * 3600
+
+# Circuit breaker: abre apos N falhas seguidas e tenta de novo com espera exponencial
+BREAKER_THRESHOLD = 5
+BREAKER_BASE_DELAY = 30
+BREAKER_MAX_DELAY = 900
+
 
 def add_log(message, level='info'):
     timestamp = datetime.now().strftime('%H:%M:%S')
     log_queue.append({'time': timestamp, 'level': level, 'message': message})
 
 
+def timed(func):
+    """Registra o tempo da funcao como etapa da requisicao atual (detalhamento dos callbacks lentos)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not has_request_context() or g.get('in_stage'):
+            return func(*args, **kwargs)
+        # So a etapa mais externa conta, para a soma nao repetir chamadas aninhadas
+        g.in_stage = True
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.in_stage = False
+            g.stages = g.get('stages', []) + [(func.__name__, time.perf_counter() - start)]
+    return wrapper
+
+
+class UpstreamUnavailable(Exception):
+    """Chamada recusada porque o circuit breaker esta aberto"""
+
+
+class TokenBucket:
+    """Limitador token-bucket compartilhado por todas as threads do processo"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Fechado -> aberto apos falhas seguidas; aberto libera uma sonda por vez com espera exponencial"""
+
+    def __init__(self, threshold, base_delay, max_delay):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.opened_at = None
+        self.delay = base_delay
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+    def ready(self):
+        """Aberto e com a espera cumprida: a proxima chamada sera uma sonda"""
+        with self.lock:
+            return (self.opened_at is not None and not self.probing and
+                    time.monotonic() - self.opened_at >= self.delay)
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.delay:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            was_open = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+            self.delay = self.base_delay
+            self.probing = False
+        if was_open:
+            add_log("Yahoo respondendo novamente, circuito fechado", 'success')
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is not None:
+                # Sonda falhou: dobra a espera ate o limite
+                self.delay = min(self.delay * 2, self.max_delay)
+                self.opened_at = time.monotonic()
+                self.probing = False
+                delay = self.delay
+            elif self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                delay = self.delay
+            else:
+                return
+        add_log(f"Yahoo indisponivel, circuito aberto (nova tentativa em {delay}s)", 'warning')
+
+
+class UpstreamSession(curl_requests.Session):
+    """Sessao curl_cffi compartilhada que conta requisicoes, conexoes novas e tempo de handshake"""
+
+    def __init__(self, **kwargs):
+        super().__init__(curl_infos=[CurlInfo.NUM_CONNECTS, CurlInfo.APPCONNECT_TIME], **kwargs)
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'connects': 0, 'handshake': 0.0}
+        # Erros de rede/HTTP da chamada em andamento nesta thread (lidos pelo upstream_call)
+        self.local = threading.local()
+
+    def request(self, *args, **kwargs):
+        # Cada requisicao HTTP paga um token, inclusive as de cookie/crumb que o yfinance faz por conta propria
+        for limiter in getattr(self.local, 'limiters', ()):
+            limiter.acquire()
+        try:
+            response = super().request(*args, **kwargs)
+        except Exception:
+            self.local.failed = True
+            raise
+        # Rate limit e erro do servidor marcam a chamada inteira; autenticacao recusada vale so se o
+        # yfinance nao conseguiu renovar o crumb na tentativa seguinte. 404 = ticker sem dados, nao e falha
+        if response.status_code == 429 or response.status_code >= 500:
+            self.local.failed = True
+        self.local.auth_failed = response.status_code in (401, 403)
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            # Conexao reaproveitada: NUM_CONNECTS = 0 e sem tempo de TCP/TLS
+            if response.infos.get(CurlInfo.NUM_CONNECTS):
+                self.stats['connects'] += 1
+                self.stats['handshake'] += response.infos.get(CurlInfo.APPCONNECT_TIME) or 0.0
+        return response
+
+    def take_stats(self):
+        """Devolve e zera os contadores"""
+        with self.stats_lock:
+            stats, self.stats = self.stats, {'requests': 0, 'connects': 0, 'handshake': 0.0}
+        return stats
+
+
+upstream_limiter = TokenBucket(UPSTREAM_RATE, UPSTREAM_BURST)
+market_limiter = TokenBucket(MARKET_RATE, MARKET_BURST)
+upstream_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_BASE_DELAY, BREAKER_MAX_DELAY)
+upstream_session = UpstreamSession(impersonate='chrome')
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_SIZE, thread_name_prefix='yahoo')
+upstream_auth = {'renewed': time.monotonic()}
+
+
+def renew_upstream_auth():
+    """Descarta cookie e crumb (guardados pelo yfinance no singleton YfData); a proxima chamada busca novos"""
+    # _cookie_lock/_cookie/_crumb sao internos do yfinance 0.2.59 (fixado no requirements.txt); revisar ao atualizar
+    data = yf.data.YfData(session=upstream_session)
+    with data._cookie_lock:
+        data._cookie = None
+        data._crumb = None
+        upstream_session.cookies.clear()
+    upstream_auth['renewed'] = time.monotonic()
+
+
+def _run_upstream(fetch, limiters):
+    """Roda no pool: devolve (resultado, excecao, se houve erro de rede/HTTP do Yahoo)"""
+    local = upstream_session.local
+    local.failed = local.auth_failed = False
+    local.limiters = limiters
+    # O cProfile so enxerga a thread em que foi ligado: perfilando uma atualizacao, cada chamada
+    # tem o seu, somado ao resultado no /debug/profile
+    profiles = profiling['upstream']
+    profiler = cProfile.Profile() if profiles is not None else None
+    if profiler:
+        profiler.enable()
+    try:
+        result, error = fetch(), None
+    except Exception as e:
+        result, error = None, e
+    finally:
+        if profiler:
+            profiler.disable()
+            profiles.append(profiler)
+    return result, error, local.failed or local.auth_failed
+
+
+def upstream_call(fetch, limiter=None):
+    """Unico ponto de acesso ao Yahoo: aplica o limitador e o circuit breaker e roda nas threads fixas
+
+    `limiter` e um orcamento extra (mapa do mercado), consumido junto com o global a cada requisicao"""
+    probe = upstream_breaker.is_open()
+    if not upstream_breaker.allow():
+        raise UpstreamUnavailable('circuito aberto')
+    # Crumb velho ou sonda apos falhas seguidas (crumb pode ter expirado): comeca com autenticacao nova
+    if probe or time.monotonic() - upstream_auth['renewed'] >= CRUMB_MAX_AGE:
+        renew_upstream_auth()
+    limiters = (limiter, upstream_limiter) if limiter else (upstream_limiter,)
+    result, error, failed = upstream_pool.submit(_run_upstream, fetch, limiters).result()
+    # So erro de rede ou HTTP conta para o circuit breaker: o yfinance devolve tabela vazia tanto para
+    # Yahoo fora do ar quanto para ticker errado/deslistado, e este ultimo nao pode abrir o circuito
+    if failed:
+        upstream_breaker.record_failure()
+    else:
+        upstream_breaker.record_success()
+    if error is not None:
+        raise error
+    return result
+
+
+def upstream_history(ticker, period):
+    return upstream_call(lambda: yf.Ticker(ticker, session=upstream_session).history(period=period))
+
+
+def upstream_json(url, params, limiter=None):
+    """GET em um endpoint JSON do Yahoo, com o cookie/crumb que o yfinance mantem na sessao compartilhada"""
+    return upstream_call(lambda: yf.data.YfData(session=upstream_session).get_raw_json(url, params=params),
+                         limiter=limiter)
+
+
+@timed
 def load_stocks():
     try:
         df = pd.read_csv('acoes.csv')
@@ -48,6 +411,7 @@ def save_stocks(df):
     try:
         df.to_csv('acoes.csv', index=False)
         add_log(f"CSV salvo com {len(df)} acoes", 'success')
+        invalidate_snapshot()
         return True
     except Exception as e:
         add_log(f"Erro ao salvar acoes.csv: {e}", 'error')
@@ -56,8 +420,7 @@ def save_stocks(df):
 
 def get_stock_data(ticker, avg_price):
     try:
-        stock = yf.Ticker(ticker)
-        hist = stock.history(period='10d')
+        hist = upstream_history(ticker, '10d')
         if hist.empty:
             add_log(f"{ticker}: Sem dados", 'warning')
             return None
@@ -97,25 +460,43 @@ def get_stock_data(ticker, avg_price):
             'change_pct_total': change_pct_total,
             'change_value_total': change_value_total
         }
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         add_log(f"Erro {ticker}: {e}", 'error')
         return None
 
 
-def fetch_stock_data():
+@timed
+def fetch_stock_data(previous=None):
+    """Snapshot da carteira; None quando nao foi possivel obter cotacoes (mantem o anterior)"""
     add_log("Iniciando busca de dados...", 'info')
     stocks_df = load_stocks()
     if stocks_df.empty:
+        # Carteira vazia e um snapshot valido (sem posicoes), nao uma falha do Yahoo
         add_log("CSV vazio", 'warning')
-        return None
+        return pd.DataFrame(columns=SNAPSHOT_COLUMNS)
+    # Ultimos valores conhecidos, usados quando um ticker falha nesta rodada
+    last_known = {}
+    if previous is not None:
+        last_known = {r['ticker']: r for r in previous.to_dict('records')}
     data_list = []
+    fresh = 0
     for _, row in stocks_df.iterrows():
-        stock_data = get_stock_data(row['ticker'], row.get('avg_price', 0))
+        try:
+            stock_data = get_stock_data(row['ticker'], row.get('avg_price', 0))
+        except UpstreamUnavailable:
+            add_log("Circuito aberto, mantendo ultimo snapshot", 'warning')
+            return None
+        if stock_data:
+            fresh += 1
+        elif row['ticker'].replace('.SA', '') in last_known:
+            stock_data = dict(last_known[row['ticker'].replace('.SA', '')])
         if stock_data:
             stock_data['shares'] = row['shares']
             stock_data['value'] = stock_data['price'] * row['shares']
             data_list.append(stock_data)
-    if not data_list:
+    if not fresh:
         add_log("Nenhum dado obtido", 'error')
         return None
     df = pd.DataFrame(data_list)
@@ -123,9 +504,134 @@ def fetch_stock_data():
     df['participation'] = (df['value'] / total_value) * 100
     df = df.sort_values('value', ascending=False).reset_index(drop=True)
     add_log(f"Dados atualizados: {len(df)} acoes", 'success')
+    stats = upstream_session.take_stats()
+    add_log(f"Yahoo desde a ultima atualizacao: {stats['requests']} requisicoes, {stats['connects']} conexoes novas "
+            f"({stats['handshake'] * 1000:.0f} ms de TCP/TLS)", 'info')
     return df
 
 
+def refresh_snapshot():
+    """Busca novas cotacoes fora do lock e troca o snapshot de uma vez so"""
+    with snapshot_lock:
+        previous = snapshot['df']
+    df = None
+    try:
+        df = fetch_stock_data(previous)
+    except Exception as e:
+        add_log(f"Erro ao atualizar cotacoes: {e}", 'error')
+    with snapshot_lock:
+        snapshot['fetched'] = time.time()
+        snapshot['running'] = False
+        if df is not None:
+            snapshot.update(df=df, updated=datetime.now(), version=snapshot['version'] + 1, stale=False)
+            updated = snapshot['updated']
+        elif snapshot['df'] is not None:
+            snapshot['stale'] = True
+    if df is not None:
+        record_history(df, updated)
+
+
+def get_snapshot():
+    """Retorna o snapshot atual na hora; quando expira, a nova busca roda em segundo plano"""
+    with snapshot_lock:
+        expired = time.time() - snapshot['fetched'] >= SNAPSHOT_TTL
+        # Com dados antigos, tenta de novo assim que o circuit breaker liberar uma sonda
+        due = (snapshot['df'] is None or expired or snapshot['invalidated'] or
+               (snapshot['stale'] and upstream_breaker.ready()))
+        if due and not snapshot['running']:
+            snapshot['running'] = True
+            snapshot['invalidated'] = False
+            threading.Thread(target=refresh_snapshot, daemon=True).start()
+        return dict(snapshot)
+
+
+def _update_daily(days, ts, value, pnl):
+    """Atualiza o agregado do dia (abertura, maxima, minima, fechamento e P&L) com um total"""
+    day = datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+    agg = days.get(day)
+    if agg is None:
+        days[day] = {'open': value, 'high': value, 'low': value, 'close': value, 'pnl': pnl, 'ts': ts}
+    elif ts >= agg['ts']:
+        agg.update(high=max(agg['high'], value), low=min(agg['low'], value), close=value, pnl=pnl, ts=ts)
+
+
+def load_daily_history():
+    """Carrega os agregados diarios e aplica apenas os registros brutos gravados depois deles"""
+    if daily_history['loaded']:
+        return
+    try:
+        with open(DAILY_HISTORY_FILE) as f:
+            saved = json.load(f)
+        daily_history.update(offset=saved['offset'], days=saved['days'])
+    except (OSError, ValueError, KeyError):
+        daily_history.update(offset=0, days={})
+
+    size = os.path.getsize(HISTORY_FILE) if os.path.exists(HISTORY_FILE) else 0
+    if size > daily_history['offset']:
+        with open(HISTORY_FILE, 'rb') as f:
+            header = f.readline().decode().strip().split(',')
+            f.seek(max(daily_history['offset'], f.tell()))
+            for chunk in pd.read_csv(f, header=None, names=header, chunksize=10000):
+                totals = chunk[chunk['ticker'] == 'TOTAL']
+                for ts, value, pnl in zip(totals['ts'], totals['value'], totals['pnl']):
+                    _update_daily(daily_history['days'], int(ts), float(value), float(pnl))
+        daily_history['offset'] = size
+        add_log(f"Historico diario reconstruido ate {daily_history['offset']} bytes", 'info')
+    daily_history['loaded'] = True
+
+
+def record_history(df, updated):
+    """Acrescenta um registro por posicao e o total da carteira, e atualiza o agregado do dia"""
+    ts = int(updated.timestamp())
+    pnl = df['change_value_total'] * df['shares']
+    records = pd.DataFrame({
+        'ts': ts,
+        'ticker': df['ticker'],
+        'price': df['price'].round(4),
+        'shares': df['shares'],
+        'value': df['value'].round(2),
+        'pnl': pnl.round(2)
+    })
+    total_value, total_pnl = round(float(df['value'].sum()), 2), round(float(pnl.sum()), 2)
+    records.loc[len(records)] = [ts, 'TOTAL', 0, 0, total_value, total_pnl]
+
+    try:
+        with history_lock:
+            load_daily_history()
+            new_file = not os.path.exists(HISTORY_FILE)
+            with open(HISTORY_FILE, 'a', newline='') as f:
+                records.to_csv(f, header=new_file, index=False)
+                offset = f.tell()
+            _update_daily(daily_history['days'], ts, total_value, total_pnl)
+            daily_history['offset'] = offset
+            tmp = f'{DAILY_HISTORY_FILE}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'offset': offset, 'days': daily_history['days']}, f)
+            os.replace(tmp, DAILY_HISTORY_FILE)
+    except Exception as e:
+        add_log(f"Erro ao gravar historico: {e}", 'error')
+
+
+def snapshot_age_text(snap):
+    """Aviso de idade quando o snapshot servido e o ultimo bom (upstream falhando)"""
+    if not snap['stale'] or snap['updated'] is None:
+        return ''
+    minutes = int((datetime.now() - snap['updated']).total_seconds() // 60)
+    return f"⚠️ Dados de {minutes} min atras (Yahoo indisponivel)"
+
+
+def snapshot_tag(snap):
+    """Identifica o snapshot (versao + horario), sem repetir apos reiniciar o servidor"""
+    return f"{snap['version']}-{snap['updated']:%Y%m%d%H%M%S%f}"
+
+
+def invalidate_snapshot():
+    """Forca nova busca na proxima leitura (ex: apos editar a carteira); nao espera a busca"""
+    with snapshot_lock:
+        snapshot['invalidated'] = True
+
+
+@timed
 def get_alerts(df):
     if df is None or df.empty:
         return []
@@ -161,7 +667,60 @@ def get_alerts(df):
     return alerts
 
 
-def get_historical_chart(ticker):
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices de ate `threshold` pontos que preservam o formato da serie"""
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    # Primeiro e ultimo ponto ficam fixos; o resto e dividido em baldes
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        # Media do proximo balde e o terceiro vertice do triangulo
+        avg_x = x[end:next_end].mean() if next_end > end else x[-1]
+        avg_y = y[end:next_end].mean() if next_end > end else y[-1]
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(areas.argmax())
+        indices[i + 1] = a
+
+    return indices
+
+
+def get_history(ticker_full, period='1mo'):
+    """Retorna a serie de fechamento do periodo, reaproveitando o cache enquanto valido"""
+    ttl = HIST_RANGES.get(period, HIST_RANGES['1mo'])[1]
+    key = (ticker_full, period)
+    with hist_cache_lock:
+        cached = hist_cache.get(key)
+    if cached and time.time() - cached[0] < ttl:
+        return cached[1]
+
+    try:
+        close = upstream_history(ticker_full, period)['Close']
+    except UpstreamUnavailable:
+        close = pd.Series(dtype=float)
+    if close.empty:
+        # Upstream falhando: serve o historico expirado, se houver
+        return cached[1] if cached else close
+    with hist_cache_lock:
+        hist_cache[key] = (time.time(), close)
+    return close
+
+
+@timed
+def get_historical_chart(ticker, period='1mo'):
     try:
         if not ticker.endswith('.SA'):
             ticker_full = f'{ticker}.SA'
@@ -169,10 +728,11 @@ def get_historical_chart(ticker):
             ticker_full = ticker
             ticker = ticker.replace('.SA', '')
 
-        stock = yf.Ticker(ticker_full)
-        hist = stock.history(period='1mo')
+        if period not in HIST_RANGES:
+            period = '1mo'
+        close = get_history(ticker_full, period)
 
-        if hist.empty:
+        if close.empty:
             return go.Figure().update_layout(
                 title='Sem dados disponiveis',
                 paper_bgcolor='#1e1e1e',
@@ -180,12 +740,16 @@ def get_historical_chart(ticker):
                 font=dict(color='#e0e0e0')
             )
 
-        color = '#66bb6a' if hist['Close'].iloc[-1] >= hist['Close'].iloc[0] else '#f44336'
+        color = '#66bb6a' if close.iloc[-1] >= close.iloc[0] else '#f44336'
+
+        # Series longas sao reduzidas no servidor mantendo picos e vales
+        keep = lttb(close.index.asi8, close.values, HIST_MAX_POINTS)
+        close = close.iloc[keep]
 
         fig = go.Figure()
         fig.add_trace(go.Scatter(
-            x=hist.index,
-            y=hist['Close'],
+            x=close.index,
+            y=close.values,
             mode='lines',
             line=dict(color=color, width=3),
             fill='tozeroy',
@@ -195,7 +759,7 @@ def get_historical_chart(ticker):
 
         fig.update_layout(
             title=dict(
-                text=f'<b>{ticker} - Ultimos 30 Dias</b>',
+                text=f'<b>{ticker} - {HIST_RANGES[period][0]}</b>',
                 font=dict(size=18, color='#e0e0e0')
             ),
             xaxis=dict(
@@ -215,7 +779,7 @@ def get_historical_chart(ticker):
             margin=dict(t=50, l=60, r=20, b=50),
             hovermode='x unified',
             images=[dict(
-                source=app.get_asset_url('foco.jpg'),
+                source=asset_url('foco.jpg'),
                 xref="paper", yref="paper",
                 x=0.5, y=0.5,
                 sizex=0.3, sizey=0.3,
@@ -225,7 +789,7 @@ def get_historical_chart(ticker):
             )]
         )
 
-        add_log(f"Grafico de {ticker} gerado", 'info')
+        add_log(f"Grafico de {ticker} ({period}) gerado com {len(close)} pontos", 'info')
         return fig
     except Exception as e:
         add_log(f"Erro ao gerar grafico de {ticker}: {e}", 'error')
@@ -237,22 +801,28 @@ def get_historical_chart(ticker):
         )
 
 
+def asset_url(name):
+    """URL do asset com ?m=<data de modificacao>, como o Dash faz com CSS/JS; muda quando o arquivo muda"""
+    path = os.path.join(app.config.assets_folder, name)
+    url = app.get_asset_url(name)
+    return f'{url}?m={int(os.path.getmtime(path))}' if os.path.exists(path) else url
+
+
+def view_columns(view_type):
+    """Colunas de variacao (%, R$) e titulo de cada tela"""
+    if view_type == 'day':
+        return 'change_pct_day', 'change_value_day', 'Variação do Dia'
+    elif view_type == '7days':
+        return 'change_pct_7days', 'change_value_7days', 'Variação dos Últimos 7 Dias'
+    return 'change_pct_total', 'change_value_total', 'Ganho/Perda Total'
+
+
+@timed
 def create_treemap(df, view_type='day'):
     if df is None or df.empty:
         return go.Figure()
 
-    if view_type == 'day':
-        change_pct_col = 'change_pct_day'
-        change_value_col = 'change_value_day'
-        title_text = 'Variação do Dia'
-    elif view_type == '7days':
-        change_pct_col = 'change_pct_7days'
-        change_value_col = 'change_value_7days'
-        title_text = 'Variação dos Últimos 7 Dias'
-    else:
-        change_pct_col = 'change_pct_total'
-        change_value_col = 'change_value_total'
-        title_text = 'Ganho/Perda Total'
+    change_pct_col, change_value_col, title_text = view_columns(view_type)
 
     labels = []
     for _, row in df.iterrows():
@@ -282,15 +852,7 @@ def create_treemap(df, view_type='day'):
         pathbar=dict(visible=False),
         marker=dict(
             colors=df[change_pct_col],
-            colorscale=[
-                [0.0, '#b71c1c'],
-                [0.4, '#d32f2f'],
-                [0.48, '#f44336'],
-                [0.5, '#546e7a'],
-                [0.52, '#66bb6a'],
-                [0.6, '#43a047'],
-                [1.0, '#1b5e20']
-            ],
+            colorscale=TREEMAP_COLORSCALE,
             cmid=0,
             colorbar=dict(
                 title=dict(text="Variação %", font=dict(color='#e0e0e0')),
@@ -332,15 +894,546 @@ def create_treemap(df, view_type='day'):
     return fig
 
 
+
+def squarify(values, width, height):
+    """Layout squarified (Bruls et al.): retorna (x, y, w, h) para cada valor, na ordem recebida (decrescente)"""
+    total = float(sum(values))
+    if total <= 0:
+        return []
+    areas = [v * width * height / total for v in values]
+
+    def worst(row, side):
+        s = sum(row)
+        return max(max(side * side * r / (s * s), (s * s) / (side * side * r)) for r in row)
+
+    rects = []
+    x, y, w, h = 0.0, 0.0, float(width), float(height)
+    row = []
+    i = 0
+    while i < len(areas) or row:
+        side = min(w, h)
+        if i < len(areas) and (not row or worst(row + [areas[i]], side) <= worst(row, side)):
+            row.append(areas[i])
+            i += 1
+            continue
+
+        # Fecha a linha atual ao longo do lado menor do espaco restante
+        row_sum = sum(row)
+        if w >= h:
+            col_w = row_sum / h
+            offset = y
+            for a in row:
+                rects.append((x, offset, col_w, a / col_w))
+                offset += a / col_w
+            x += col_w
+            w -= col_w
+        else:
+            row_h = row_sum / w
+            offset = x
+            for a in row:
+                rects.append((offset, y, a / row_h, row_h))
+                offset += a / row_h
+            y += row_h
+            h -= row_h
+        row = []
+
+    return rects
+
+
+def treemap_color(value, vmax):
+    """Interpola a escala do treemap com o centro em 0, como o cmid=0 do Plotly"""
+    pos = 0.5 if vmax <= 0 else min(max(0.5 + value / (2 * vmax), 0.0), 1.0)
+    for (p0, c0), (p1, c1) in zip(TREEMAP_COLORSCALE, TREEMAP_COLORSCALE[1:]):
+        if pos <= p1:
+            t = 0 if p1 == p0 else (pos - p0) / (p1 - p0)
+            rgb = [round(int(c0[k:k + 2], 16) + t * (int(c1[k:k + 2], 16) - int(c0[k:k + 2], 16))) for k in (1, 3, 5)]
+            return '#{:02x}{:02x}{:02x}'.format(*rgb)
+    return TREEMAP_COLORSCALE[-1][1]
+
+
+# Proporcao usada no layout do quiosque (telas 16:9)
+KIOSK_WIDTH = 160
+KIOSK_HEIGHT = 90
+
+KIOSK_TEMPLATE = """<!DOCTYPE html>
+<html lang="pt-br"><head><meta charset="utf-8">
+<meta http-equiv="refresh" content="{refresh}">
+<title>Mapa de Acoes</title>
+<style>
+html,body{{margin:0;height:100%;background:#121212;color:#fff;font-family:'Segoe UI',Arial,sans-serif;overflow:hidden}}
+.v{{display:none;position:absolute;inset:0}}.v:first-of-type{{display:block}}
+h1{{margin:0;height:6vh;line-height:6vh;text-align:center;font-size:3.2vh;color:#e0e0e0}}
+h1 small{{font-size:1.8vh;color:#78909c;margin-left:2vh}}
+.m{{position:absolute;top:6vh;left:0;right:0;bottom:0}}
+.m div{{position:absolute;box-sizing:border-box;border:.3vh solid #1a1a1a;display:flex;flex-direction:column;justify-content:center;align-items:center;text-align:center;overflow:hidden;line-height:1.2}}
+.m b{{font-size:1.1em}}.m i{{font-style:normal;font-size:.8em}}
+</style></head><body>
+{views}
+<script>
+var v=document.querySelectorAll('.v'),t=[{times}],i=0;
+function s(){{for(var j=0;j<v.length;j++)v[j].style.display=j==i?'block':'none';setTimeout(function(){{i=(i+1)%v.length;s()}},t[i]*1000)}}
+if(v.length>1)s();
+</script>
+</body></html>"""
+
+
+def render_kiosk_view(df, view_type, updated, warning=''):
+    """Gera o HTML de uma tela do treemap com retangulos posicionados em % (sem JS)"""
+    change_pct_col, change_value_col, title_text = view_columns(view_type)
+    df = df[df['value'] > 0]
+    rects = squarify(df['value'].tolist(), KIOSK_WIDTH, KIOSK_HEIGHT)
+    vmax = df[change_pct_col].abs().max() if not df.empty else 0
+
+    cells = []
+    for (x, y, w, h), (_, row) in zip(rects, df.iterrows()):
+        pct = row[change_pct_col]
+        arrow = "▲" if pct >= 0 else "▼"
+        sign = "+" if pct >= 0 else ""
+        # Fonte proporcional ao menor lado do retangulo (em vh)
+        font = min(w, h) * 100 / KIOSK_HEIGHT / 7
+        text = ''
+        if font >= 0.9:
+            text = (f"<b>{row['ticker']} {arrow}</b>R$ {row['price']:.2f}"
+                    f"<i>{sign}{pct:.2f}% ({sign}R$ {row[change_value_col]:.2f})</i>")
+        cells.append(
+            f'<div style="left:{x * 100 / KIOSK_WIDTH:.2f}%;top:{y * 100 / KIOSK_HEIGHT:.2f}%;'
+            f'width:{w * 100 / KIOSK_WIDTH:.2f}%;height:{h * 100 / KIOSK_HEIGHT:.2f}%;'
+            f'background:{treemap_color(pct, vmax)};font-size:{min(font, 3.5):.2f}vh">{text}</div>'
+        )
+
+    stamp = updated.strftime('%d/%m/%Y %H:%M') if updated else ''
+    if warning:
+        stamp = f'{stamp} {warning}'
+    return f'<section class="v"><h1>{title_text}<small>{stamp}</small></h1><div class="m">{"".join(cells)}</div></section>'
+
+
+@app.server.route('/kiosk')
+def kiosk():
+    """Pagina estatica para telas de baixo consumo: /kiosk?daily=20&weekly=10&monthly=0 (0 desabilita)"""
+    times = [request.args.get(name, DEFAULT_TIMES[name] if DEFAULT_ENABLED[name] else 0, type=int)
+             for name in ('daily', 'weekly', 'monthly')]
+    views = [(view, max(t, 5)) for view, t in zip(['day', '7days', 'total'], times) if t > 0] or [('day', DEFAULT_TIMES['daily'])]
+
+    snap = get_snapshot()
+    if snap['df'] is None:
+        # Primeira busca ainda em andamento: a pagina tenta de novo sozinha
+        return Response('<meta http-equiv="refresh" content="5"><h1 style="color:#f44336">Sem dados</h1>',
+                        status=503, mimetype='text/html')
+
+    warning = snapshot_age_text(snap)
+    key = (snap['version'], warning, tuple(views), snap['running'])
+    with kiosk_cache_lock:
+        cached = kiosk_cache.get(key)
+    if cached is None:
+        page = KIOSK_TEMPLATE.format(
+            # Busca em andamento: recarrega logo para pegar o snapshot novo
+            refresh=15 if snap['running'] else BREAKER_BASE_DELAY * 2 if warning else SNAPSHOT_TTL + 10,
+            views='\n'.join(render_kiosk_view(snap['df'], view, snap['updated'], warning) for view, _ in views),
+            times=','.join(str(t) for _, t in views)
+        )
+        etag = hashlib.sha1(f"{snapshot_tag(snap)}|{warning}|{views}|{snap['running']}".encode()).hexdigest()[:16]
+        cached = (page, etag)
+        with kiosk_cache_lock:
+            # Mantem apenas as paginas do snapshot atual
+            for old in [k for k in kiosk_cache if k[0] != snap['version']]:
+                kiosk_cache.pop(old, None)
+            kiosk_cache[key] = cached
+
+    # Recarregar sem snapshot novo recebe 304 sem corpo; o flask-compress acrescenta o algoritmo
+    # ao ETag ("abc:gzip"), entao qualquer variante vale
+    page, etag = cached
+    if any(request.if_none_match.contains(etag + suffix) for suffix in ('', ':br', ':gzip')):
+        response = Response(status=304)
+    else:
+        response = Response(page, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def price_gap_period(last):
+    """Menor periodo do Yahoo que cobre os dias desde `last` (fechamento mais recente da matriz)"""
+    days = (pd.Timestamp.now().normalize() - last).days if last is not None else None
+    for period, limit in (('5d', 4), ('1mo', 25), ('3mo', 85)):
+        if days is not None and days <= limit:
+            return period
+    return '1y'
+
+
+def get_price_matrix(tickers):
+    """Fechamentos diarios (1 ano) das acoes; uma vez por dia busca so os dias que faltam"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    with price_matrix_lock:
+        df = price_matrix['df']
+        if df is None and os.path.exists(PRICE_MATRIX_FILE):
+            df = pd.read_csv(PRICE_MATRIX_FILE, index_col=0, parse_dates=True)
+            price_matrix['df'] = df
+            price_matrix['date'] = datetime.fromtimestamp(os.path.getmtime(PRICE_MATRIX_FILE)).strftime('%Y-%m-%d')
+        updated = price_matrix['date'] == today
+    if df is None:
+        df = pd.DataFrame()
+
+    # Novo dia: acrescenta os dias recentes de quem ja esta na matriz; ticker novo: o ano todo
+    if updated:
+        to_fetch = {t: '1y' for t in tickers if t not in df.columns}
+    else:
+        to_fetch = {t: price_gap_period(df[t].last_valid_index()) if t in df.columns else '1y' for t in tickers}
+
+    # As buscas ficam fora do lock; so o calculo de risco (uma thread por vez) chega aqui
+    columns, complete = {}, True
+    for ticker, period in to_fetch.items():
+        try:
+            close = upstream_history(f'{ticker}.SA', period)['Close']
+        except UpstreamUnavailable:
+            add_log("Circuito aberto, matriz de precos incompleta", 'warning')
+            complete = False
+            break
+        except Exception as e:
+            add_log(f"Erro no historico de {ticker}: {e}", 'error')
+            complete = False
+            continue
+        if not close.empty:
+            close.index = close.index.tz_localize(None).normalize()
+            columns[ticker] = close
+
+    if columns:
+        # Valores novos substituem os antigos (o ultimo pregao pode ter vindo parcial); o resto fica
+        df = pd.DataFrame(columns).combine_first(df).sort_index()
+        df = df[df.index >= pd.Timestamp.now().normalize() - pd.DateOffset(years=1)]
+        add_log(f"Matriz de precos atualizada: {len(columns)} tickers", 'info')
+    with price_matrix_lock:
+        price_matrix['df'] = df
+        # Falha no meio: mantem a matriz antiga para os que faltaram e tenta de novo no proximo calculo
+        if complete:
+            price_matrix['date'] = today
+            if columns:
+                df.to_csv(PRICE_MATRIX_FILE)
+
+    return df[[t for t in tickers if t in df.columns]]
+
+
+def compute_risk(snapshot_df):
+    """Correlacao, volatilidade anual e contribuicao de cada posicao para o risco (NumPy vetorizado)"""
+    prices = get_price_matrix(snapshot_df['ticker'].tolist())
+    if prices.shape[1] < 2:
+        return None
+
+    # Retornos logaritmicos diarios; dias sem preco de alguma acao sao descartados
+    matrix = prices.ffill().dropna().to_numpy(dtype=np.float64)
+    returns = np.diff(np.log(matrix), axis=0)
+    if len(returns) < 20:
+        return None
+
+    tickers = list(prices.columns)
+    values = snapshot_df.set_index('ticker').loc[tickers, 'value'].to_numpy(dtype=np.float64)
+    weights = values / values.sum()
+
+    cov = np.cov(returns, rowvar=False) * 252
+    vol = np.sqrt(np.diag(cov))
+    corr = cov / np.outer(vol, vol)
+    portfolio_vol = float(np.sqrt(weights @ cov @ weights))
+    # Contribuicao de Euler: w_i * (Cov w)_i / sigma_p, soma igual a sigma_p
+    contribution = weights * (cov @ weights) / portfolio_vol
+
+    order = np.argsort(-contribution)
+    return {
+        'tickers': [tickers[i] for i in order],
+        'corr': corr[np.ix_(order, order)].round(3),
+        'vol': vol[order] * 100,
+        'weights': weights[order] * 100,
+        'contribution': contribution[order] / portfolio_vol * 100,
+        'portfolio_vol': portfolio_vol * 100,
+        'days': len(returns)
+    }
+
+
+def refresh_risk(snap):
+    try:
+        result = compute_risk(snap['df'])
+        with risk_lock:
+            risk_cache.update(version=snap['version'], result=result)
+    except Exception as e:
+        add_log(f"Erro ao calcular risco: {e}", 'error')
+    finally:
+        with risk_lock:
+            risk_cache['running'] = False
+
+
+def get_risk():
+    """Resultado do snapshot atual; se ainda nao existe, calcula em segundo plano e devolve o anterior"""
+    snap = get_snapshot()
+    if snap['df'] is None:
+        return None, False
+    with risk_lock:
+        if risk_cache['version'] == snap['version']:
+            return risk_cache['result'], False
+        if not risk_cache['running']:
+            risk_cache['running'] = True
+            threading.Thread(target=refresh_risk, args=(snap,), daemon=True).start()
+        return risk_cache['result'], True
+
+
+def create_risk_figure():
+    risk, pending = get_risk()
+    if risk is None:
+        return go.Figure().update_layout(
+            title='Calculando correlacoes...' if pending else 'Dados insuficientes para a tela de risco',
+            paper_bgcolor='#1e1e1e',
+            plot_bgcolor='#1e1e1e',
+            font=dict(color='#e0e0e0'),
+            height=900
+        )
+
+    tickers = risk['tickers']
+    fig = make_subplots(rows=1, cols=2, column_widths=[0.62, 0.38], horizontal_spacing=0.1,
+                        subplot_titles=('Correlacao dos Retornos Diarios', 'Peso x Contribuicao para o Risco'))
+    fig.add_trace(go.Heatmap(
+        z=risk['corr'],
+        x=tickers,
+        y=tickers,
+        zmin=-1,
+        zmax=1,
+        colorscale=TREEMAP_COLORSCALE,
+        colorbar=dict(x=0.56, thickness=12, len=0.8, tickfont=dict(color='#e0e0e0')),
+        hovertemplate='%{y} x %{x}: %{z:.2f}<extra></extra>'
+    ), row=1, col=1)
+    fig.add_trace(go.Bar(
+        y=tickers,
+        x=risk['weights'],
+        orientation='h',
+        name='Peso %',
+        marker_color='#546e7a',
+        customdata=risk['vol'],
+        hovertemplate='%{y}: peso %{x:.1f}% (vol. %{customdata:.1f}% a.a.)<extra></extra>'
+    ), row=1, col=2)
+    fig.add_trace(go.Bar(
+        y=tickers,
+        x=risk['contribution'],
+        orientation='h',
+        name='Risco %',
+        marker_color='#f44336',
+        hovertemplate='%{y}: %{x:.1f}% do risco<extra></extra>'
+    ), row=1, col=2)
+
+    fig.update_layout(
+        title=dict(
+            text=f"<b>Risco da Carteira</b> — volatilidade {risk['portfolio_vol']:.1f}% a.a. ({risk['days']} pregoes)",
+            x=0.5,
+            xanchor='center',
+            font=dict(size=24, color='#e0e0e0')
+        ),
+        barmode='group',
+        legend=dict(orientation='h', x=0.75, y=1.02, xanchor='center', font=dict(color='#e0e0e0')),
+        margin=dict(t=90, l=70, r=20, b=60),
+        height=900,
+        paper_bgcolor='#1e1e1e',
+        plot_bgcolor='#1e1e1e',
+        font=dict(color='#e0e0e0')
+    )
+    fig.update_yaxes(autorange='reversed', row=1, col=2)
+    fig.update_yaxes(autorange='reversed', row=1, col=1)
+    fig.update_xaxes(ticksuffix='%', gridcolor='#37474f', row=1, col=2)
+    return fig
+
+
+def load_market_universe():
+    """Tickers do mercado.csv (com sufixo .SA), sem repeticao e na ordem do arquivo"""
+    try:
+        tickers = pd.read_csv(MARKET_FILE)['ticker'].dropna().str.strip().str.upper()
+    except Exception as e:
+        add_log(f"Erro ao carregar {MARKET_FILE}: {e}", 'error')
+        return []
+    return list(dict.fromkeys(t if t.endswith('.SA') else f'{t}.SA' for t in tickers))
+
+
+def _market_value(quote, key):
+    value = quote.get(key)
+    return np.nan if value is None else value
+
+
+def fetch_market_quotes(tickers, index, quotes):
+    """Preco, variacao do dia e valor de mercado: uma requisicao por lote de MARKET_BATCH tickers"""
+    for i in range(0, len(tickers), MARKET_BATCH):
+        params = {'symbols': ','.join(tickers[i:i + MARKET_BATCH]), 'formatted': 'false',
+                  'fields': 'regularMarketPrice,regularMarketChangePercent,marketCap'}
+        try:
+            result = upstream_json(MARKET_QUOTE_URL, params, limiter=market_limiter)
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            add_log(f"Erro nas cotacoes do mercado (lote {i // MARKET_BATCH + 1}): {e}", 'error')
+            continue
+        for quote in (result.get('quoteResponse') or {}).get('result') or []:
+            row = index.get(quote.get('symbol'))
+            if row is not None:
+                quotes[row, 0] = _market_value(quote, 'regularMarketPrice')
+                quotes[row, 1] = _market_value(quote, 'regularMarketChangePercent')
+                quotes[row, 3] = _market_value(quote, 'marketCap')
+
+
+def fetch_market_week(tickers, index):
+    """Fechamento de 7 pregoes atras de cada ticker: uma requisicao por lote de MARKET_SPARK_BATCH tickers"""
+    week = np.full(len(tickers), np.nan)
+    for i in range(0, len(tickers), MARKET_SPARK_BATCH):
+        params = {'symbols': ','.join(tickers[i:i + MARKET_SPARK_BATCH]), 'range': '1mo', 'interval': '1d'}
+        try:
+            result = upstream_json(MARKET_SPARK_URL, params, limiter=market_limiter)
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            add_log(f"Erro nos fechamentos do mercado (lote {i // MARKET_SPARK_BATCH + 1}): {e}", 'error')
+            continue
+        for symbol, series in result.items():
+            closes = [c for c in (series or {}).get('close') or [] if c is not None]
+            if symbol in index and closes:
+                week[index[symbol]] = closes[-8] if len(closes) >= 8 else closes[0]
+    return week
+
+
+def refresh_market():
+    """Busca as cotacoes do universo em lotes e regrava as colunas float32 do mercado"""
+    start = time.perf_counter()
+    try:
+        tickers = load_market_universe()
+        index = {t: i for i, t in enumerate(tickers)}
+        quotes = np.full((len(tickers), len(MARKET_COLUMNS)), np.nan, dtype=np.float32)
+        try:
+            fetch_market_quotes(tickers, index, quotes)
+            week = fetch_market_week(tickers, index)
+        except UpstreamUnavailable:
+            add_log("Circuito aberto, mapa do mercado mantido", 'warning')
+            return
+        if np.isnan(quotes[:, 0]).all():
+            add_log("Mapa do mercado: nenhuma cotacao obtida", 'error')
+            return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            quotes[:, 2] = (quotes[:, 0] / week - 1) * 100
+
+        with market_lock:
+            # Tickers sem cotacao nesta rodada ficam com o ultimo valor conhecido
+            missing = np.isnan(quotes[:, 0])
+            if market['quotes'] is not None and missing.any():
+                old = market['index']
+                for row in np.flatnonzero(missing):
+                    if tickers[row] in old:
+                        quotes[row] = market['quotes'][old[tickers[row]]]
+            market.update(tickers=tickers, index=index, quotes=quotes,
+                          updated=datetime.now(), version=market['version'] + 1)
+        valid = int(np.count_nonzero(~np.isnan(quotes[:, 3])))
+        add_log(f"Mapa do mercado atualizado: {valid}/{len(tickers)} tickers em {time.perf_counter() - start:.0f}s",
+                'success')
+    except Exception as e:
+        add_log(f"Erro ao atualizar o mapa do mercado: {e}", 'error')
+    finally:
+        with market_lock:
+            market['fetched'] = time.time()
+            market['running'] = False
+
+
+def get_market():
+    """Colunas atuais do mercado; quando expiram, renova em segundo plano e devolve as anteriores"""
+    with market_lock:
+        if time.time() - market['fetched'] >= MARKET_TTL and not market['running']:
+            market['running'] = True
+            threading.Thread(target=refresh_market, daemon=True).start()
+        return dict(market)
+
+
+@timed
+def create_market_treemap(view_type='day'):
+    mkt = get_market()
+    quotes = mkt['quotes']
+    if quotes is None:
+        return go.Figure().update_layout(
+            title='Carregando mapa do mercado...',
+            paper_bgcolor='#1e1e1e',
+            plot_bgcolor='#1e1e1e',
+            font=dict(color='#e0e0e0'),
+            height=900
+        )
+    # Todos os navegadores compartilham a figura da versao atual do mercado
+    key = (mkt['version'], view_type)
+    with market_lock:
+        fig = market_figures.get(key)
+    if fig is not None:
+        return fig
+
+    # Recolorir so troca a coluna de variacao; sem preco ou valor de mercado o ticker fica de fora
+    change_col = MARKET_COLUMNS.index('change_pct_7days' if view_type == '7days' else 'change_pct_day')
+    rows = np.flatnonzero(~np.isnan(quotes[:, 3]) & (quotes[:, 3] > 0))
+    tickers = [mkt['tickers'][i].replace('.SA', '') for i in rows]
+    change = np.nan_to_num(quotes[rows, change_col])
+    title_text = 'Variação dos Últimos 7 Dias' if view_type == '7days' else 'Variação do Dia'
+
+    fig = go.Figure(go.Treemap(
+        labels=tickers,
+        parents=[''] * len(tickers),
+        values=quotes[rows, 3],
+        texttemplate="<b>%{label}</b><br>%{color:+.2f}%",
+        textposition='middle center',
+        textfont=dict(size=12, color='white', family='Segoe UI, Arial'),
+        pathbar=dict(visible=False),
+        marker=dict(
+            colors=change,
+            colorscale=TREEMAP_COLORSCALE,
+            cmid=0,
+            colorbar=dict(
+                title=dict(text="Variação %", font=dict(color='#e0e0e0')),
+                ticksuffix="%",
+                x=1.02,
+                thickness=15,
+                len=0.5,
+                bgcolor='#263238',
+                tickfont=dict(color='#e0e0e0'),
+                bordercolor='#37474f',
+                borderwidth=2
+            ),
+            line=dict(width=1, color='#1a1a1a')
+        ),
+        hovertemplate=(
+            '<b style="font-size:14px">%{label}</b><br><br>'
+            '<span style="font-size:13px">Preco: R$ %{customdata[0]:,.2f}</span><br>'
+            '<span style="font-size:13px">Variacao: %{color:+.2f}%</span><br>'
+            '<span style="font-size:13px">Valor de mercado: R$ %{customdata[1]:,.1f} bi</span>'
+            '<extra></extra>'
+        ),
+        customdata=np.column_stack([quotes[rows, 0], quotes[rows, 3] / 1e9])
+    ))
+
+    updated = mkt['updated'].strftime('%H:%M') if mkt['updated'] else ''
+    fig.update_layout(
+        title=dict(
+            text=f'<b>Mapa do Mercado — {title_text}</b> <span style="font-size:14px">({len(tickers)} acoes, {updated})</span>',
+            x=0.5,
+            xanchor='center',
+            font=dict(size=24, color='#e0e0e0')
+        ),
+        margin=dict(t=70, l=10, r=110, b=10),
+        height=900,
+        paper_bgcolor='#1e1e1e',
+        plot_bgcolor='#1e1e1e',
+        font=dict(color='#e0e0e0')
+    )
+    with market_lock:
+        for old in [k for k in market_figures if k[0] != mkt['version']]:
+            market_figures.pop(old, None)
+        market_figures[key] = fig
+    return fig
+
+
 def build_rotation_map(settings, enabled):
     """Constroi o mapa de rotacao baseado nas configuracoes de tempo e telas habilitadas"""
     daily_time = settings.get('daily', DEFAULT_TIMES['daily'])
     weekly_time = settings.get('weekly', DEFAULT_TIMES['weekly'])
     monthly_time = settings.get('monthly', DEFAULT_TIMES['monthly'])
+    risk_time = settings.get('risk', DEFAULT_TIMES['risk'])
+    market_time = settings.get('market', DEFAULT_TIMES['market'])
 
     daily_enabled = enabled.get('daily', True)
     weekly_enabled = enabled.get('weekly', True)
     monthly_enabled = enabled.get('monthly', True)
+    risk_enabled = enabled.get('risk', DEFAULT_ENABLED['risk'])
+    market_enabled = enabled.get('market', DEFAULT_ENABLED['market'])
 
     # Cada item no mapa representa 5 segundos
     rotation_map = []
@@ -357,6 +1450,16 @@ def build_rotation_map(settings, enabled):
         monthly_slots = monthly_time // 5
         rotation_map.extend([2] * monthly_slots)
 
+    if risk_enabled:
+        risk_slots = risk_time // 5
+        rotation_map.extend([3] * risk_slots)
+
+    if market_enabled:
+        # Metade do tempo com a variacao do dia (4), metade com a de 7 dias (5)
+        market_slots = market_time // 5
+        day_slots = (market_slots + 1) // 2
+        rotation_map.extend([4] * day_slots + [5] * (market_slots - day_slots))
+
     # Se nenhuma tela estiver habilitada, retorna apenas a diaria
     return rotation_map if rotation_map else [0, 0, 0, 0]
 
@@ -378,7 +1481,7 @@ def main_layout():
                 html.Div([
                     html.Div([
                         html.Img(
-                            src=app.get_asset_url('foco.jpg'),
+                            src=asset_url('foco.jpg'),
                             style={
                                 'height': '60px',
                                 'width': '60px',
@@ -392,7 +1495,7 @@ def main_layout():
                             style={'display': 'inline-block', 'color': '#66bb6a', 'margin': '0', 'vertical-align': 'middle'}
                         ),
                         html.Img(
-                            src=app.get_asset_url('foco.jpg'),
+                            src=asset_url('foco.jpg'),
                             style={
                                 'height': '60px',
                                 'width': '60px',
@@ -428,9 +1531,24 @@ def main_layout():
                                 'height': '45px',
                                 'font-size': '22px',
                                 'cursor': 'pointer',
-                                'box-shadow': '0 4px 12px rgba(25,118,210,0.4)'
+                                'box-shadow': '0 4px 12px rgba(25,118,210,0.4)',
+                                'margin-right': '8px'
                             }),
                             href='/logs'
+                        ),
+                        html.A(
+                            html.Button('📈', style={
+                                'border': 'none',
+                                'background': '#6a1b9a',
+                                'color': 'white',
+                                'border-radius': '50%',
+                                'width': '45px',
+                                'height': '45px',
+                                'font-size': '22px',
+                                'cursor': 'pointer',
+                                'box-shadow': '0 4px 12px rgba(106,27,154,0.4)'
+                            }),
+                            href='/evolucao'
                         )
                     ], style={'position': 'absolute', 'right': '30px', 'top': '30px', 'display': 'flex'})
                 ], style={'position': 'relative', 'margin-bottom': '10px'}),
@@ -456,6 +1574,23 @@ def main_layout():
         dbc.Modal([
             dbc.ModalHeader(dbc.ModalTitle(id='modal-title')),
             dbc.ModalBody([
+                dbc.RadioItems(
+                    id='hist-range',
+                    options=[
+                        {'label': '1M', 'value': '1mo'},
+                        {'label': '1A', 'value': '1y'},
+                        {'label': '5A', 'value': '5y'},
+                        {'label': 'Max', 'value': 'max'}
+                    ],
+                    value='1mo',
+                    inline=True,
+                    className='btn-group',
+                    inputClassName='btn-check',
+                    labelClassName='btn btn-outline-success btn-sm',
+                    labelCheckedClassName='active',
+                    style={'margin-bottom': '10px'}
+                ),
+                html.Span('⏳ Carregando...', id='hist-loading', style={'display': 'none', 'color': '#78909c', 'margin-left': '15px'}),
                 dcc.Graph(id='historical-chart', config={'displayModeBar': False})
             ]),
             dbc.ModalFooter(
@@ -464,9 +1599,11 @@ def main_layout():
         ], id="modal", size="lg", is_open=False),
 
         dcc.Store(id='data'),
+        dcc.Store(id='data-version'),
         dcc.Store(id='view', data=0),
+        dcc.Store(id='hist-ticker'),
         dcc.Interval(id='rotate', interval=5000, n_intervals=0),
-        dcc.Interval(id='fetch', interval=300000, n_intervals=0),
+        dcc.Interval(id='fetch', interval=FETCH_WAIT_MS, n_intervals=0),
         dcc.Interval(id='countdown-timer', interval=1000, n_intervals=0)
     ], fluid=True, style={'padding': '20px', 'background-color': '#121212', 'min-height': '100vh'})
 
@@ -495,6 +1632,22 @@ def logs_layout():
     ], fluid=True, style={'padding': '30px', 'background-color': '#121212', 'min-height': '100vh', 'max-width': '1400px'})
 
 
+def evolution_layout():
+    return dbc.Container([
+        html.H2('📈 Evolucao da Carteira', className='text-center mb-4', style={'color': '#ab47bc', 'margin-top': '20px'}),
+
+        dbc.Button('← Voltar', href='/', color='secondary', size='lg', className='mb-4', style={'border-radius': '8px'}),
+
+        dbc.Card([
+            dbc.CardBody([
+                dcc.Graph(id='evolution-chart', config={'displayModeBar': False})
+            ])
+        ], style={'border-radius': '12px'}),
+
+        dcc.Interval(id='evolution-update', interval=300000, n_intervals=0)
+    ], fluid=True, style={'padding': '30px', 'background-color': '#121212', 'min-height': '100vh', 'max-width': '1400px'})
+
+
 def edit_layout():
     return dbc.Container([
         html.H2(
@@ -534,7 +1687,7 @@ def edit_layout():
                                 dbc.Input(id='input-time-daily', type='number', value=20, min=5, step=5, size='lg')
                             ])
                         ], style={'background-color': '#263238', 'border': '1px solid #37474f'})
-                    ], width=4),
+                    ], width=True),
 
                     dbc.Col([
                         dbc.Card([
@@ -551,7 +1704,7 @@ def edit_layout():
                                 dbc.Input(id='input-time-weekly', type='number', value=10, min=5, step=5, size='lg')
                             ])
                         ], style={'background-color': '#263238', 'border': '1px solid #37474f'})
-                    ], width=4),
+                    ], width=True),
 
                     dbc.Col([
                         dbc.Card([
@@ -568,7 +1721,41 @@ def edit_layout():
                                 dbc.Input(id='input-time-monthly', type='number', value=10, min=5, step=5, size='lg')
                             ])
                         ], style={'background-color': '#263238', 'border': '1px solid #37474f'})
-                    ], width=4)
+                    ], width=True),
+
+                    dbc.Col([
+                        dbc.Card([
+                            dbc.CardBody([
+                                html.Div([
+                                    dbc.Switch(
+                                        id='switch-risk',
+                                        value=False,
+                                        label='',
+                                        style={'transform': 'scale(1.3)', 'margin-right': '10px'}
+                                    ),
+                                    html.Span('Tela de Risco', style={'font-weight': 'bold', 'color': '#e0e0e0', 'font-size': '16px'})
+                                ], style={'display': 'flex', 'align-items': 'center', 'margin-bottom': '10px'}),
+                                dbc.Input(id='input-time-risk', type='number', value=10, min=5, step=5, size='lg')
+                            ])
+                        ], style={'background-color': '#263238', 'border': '1px solid #37474f'})
+                    ], width=True),
+
+                    dbc.Col([
+                        dbc.Card([
+                            dbc.CardBody([
+                                html.Div([
+                                    dbc.Switch(
+                                        id='switch-market',
+                                        value=False,
+                                        label='',
+                                        style={'transform': 'scale(1.3)', 'margin-right': '10px'}
+                                    ),
+                                    html.Span('Mapa do Mercado', style={'font-weight': 'bold', 'color': '#e0e0e0', 'font-size': '16px'})
+                                ], style={'display': 'flex', 'align-items': 'center', 'margin-bottom': '10px'}),
+                                dbc.Input(id='input-time-market', type='number', value=20, min=5, step=5, size='lg')
+                            ])
+                        ], style={'background-color': '#263238', 'border': '1px solid #37474f'})
+                    ], width=True)
                 ]),
 
                 html.Div(id='validation-warning', style={'margin-top': '15px', 'font-weight': 'bold', 'font-size': '14px'}),
@@ -616,13 +1803,74 @@ def edit_layout():
             ])
         ], className='mb-4', style={'border-radius': '12px'}),
 
+        dbc.Card([
+            dbc.CardBody([
+                html.H4('📥 Importar Negociacoes', className='mb-4', style={'color': '#66bb6a'}),
+                html.P('CSV exportado da B3/corretora (Data, Tipo de Movimentacao, Codigo de Negociacao, Quantidade, Preco). '
+                       'Reimportar o mesmo arquivo processa apenas as linhas novas.',
+                       style={'color': '#b0bec5', 'margin-bottom': '20px'}),
+                dbc.Row([
+                    dbc.Col([
+                        dbc.Label('Caminho do arquivo no servidor', style={'font-weight': 'bold'}),
+                        dbc.Input(id='input-import-path', type='text', placeholder='negociacoes.csv', size='lg')
+                    ], width=8),
+                    dbc.Col([
+                        dbc.Label('Refazer do zero', style={'font-weight': 'bold'}),
+                        dbc.Switch(id='switch-import-reset', value=False, label='', style={'transform': 'scale(1.3)', 'margin-top': '10px'})
+                    ], width=4)
+                ]),
+                dbc.Button(
+                    'Importar',
+                    id='btn-import',
+                    n_clicks=0,
+                    color='success',
+                    size='lg',
+                    className='mt-3',
+                    style={'font-weight': 'bold', 'border-radius': '8px', 'padding': '12px 40px'}
+                ),
+                html.Div(id='import-message', style={'margin-top': '15px', 'font-weight': 'bold', 'font-size': '15px'})
+            ])
+        ], className='mb-4', style={'border-radius': '12px'}),
+
         dbc.Card([
             dbc.CardBody([
                 html.H4('📋 Acoes Cadastradas', className='mb-4', style={'color': '#66bb6a'}),
-                html.Div(id='stocks-table'),
+                html.Div(id='stocks-empty'),
+                dash_table.DataTable(
+                    id='stocks-table',
+                    columns=[
+                        {'name': 'Ticker', 'id': 'ticker', 'editable': False},
+                        {'name': 'Quantidade', 'id': 'shares', 'type': 'numeric'},
+                        {'name': 'Preco Medio', 'id': 'avg_price', 'type': 'numeric',
+                         'format': dash_table.FormatTemplate.money(2).symbol_prefix('R$ ')}
+                    ],
+                    editable=True,
+                    row_deletable=True,
+                    page_current=0,
+                    page_size=STOCKS_PAGE_SIZE,
+                    page_action='custom',
+                    sort_action='custom',
+                    sort_mode='multi',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
+                    style_table={'overflow-x': 'auto'},
+                    style_header={
+                        'background-color': '#1e1e1e', 'color': '#66bb6a', 'font-weight': 'bold',
+                        'font-size': '16px', 'border-bottom': '2px solid #66bb6a'
+                    },
+                    style_filter={'background-color': '#263238', 'color': '#e0e0e0'},
+                    style_cell={
+                        'background-color': '#1e1e1e', 'color': '#e0e0e0', 'padding': '12px',
+                        'border': 'none', 'border-bottom': '1px solid #37474f', 'font-size': '15px'
+                    },
+                    style_cell_conditional=[
+                        {'if': {'column_id': 'ticker'}, 'text-align': 'left', 'font-weight': 'bold', 'color': '#66bb6a'},
+                        {'if': {'column_id': 'shares'}, 'text-align': 'center'}
+                    ]
+                ),
                 html.Div(id='delete-message', style={'margin-top': '15px', 'font-weight': 'bold', 'font-size': '15px'}),
-                dcc.Store(id='update-trigger', data=0),
-                html.Div(id='delete-trigger', style={'display': 'none'})
+                dcc.Store(id='update-trigger', data=0)
             ])
         ], style={'border-radius': '12px'})
     ], fluid=True, style={'padding': '30px', 'background-color': '#121212', 'min-height': '100vh', 'max-width': '1400px'})
@@ -634,15 +1882,31 @@ def display_page(pathname):
         return edit_layout()
     elif pathname == '/logs':
         return logs_layout()
+    elif pathname == '/evolucao':
+        return evolution_layout()
     return main_layout()
 
 
-@app.callback([Output('data', 'data'), Output('time', 'children')], Input('fetch', 'n_intervals'))
-def update_data(n):
-    df = fetch_stock_data()
-    if df is not None:
-        return df.to_dict('records'), f"🕐 Atualizado em {datetime.now().strftime('%d/%m/%Y as %H:%M:%S')}"
-    return None, "❌ Erro"
+@app.callback([Output('data', 'data'), Output('time', 'children'), Output('data-version', 'data'),
+               Output('fetch', 'interval')],
+              Input('fetch', 'n_intervals'), State('data-version', 'data'))
+def update_data(n, version):
+    snap = get_snapshot()
+    if snap['df'] is None:
+        if snap['running']:
+            return None, "⏳ Buscando cotacoes...", None, FETCH_WAIT_MS
+        return None, "❌ Erro", None, FETCH_POLL_MS
+    # O navegador ja tem este snapshot: nada a enviar (o treemap nao e redesenhado)
+    tag = snapshot_tag(snap)
+    if tag == version and not snap['stale']:
+        raise PreventUpdate
+    if snap['stale']:
+        text = f"{snapshot_age_text(snap)} - ultima atualizacao {snap['updated'].strftime('%d/%m/%Y as %H:%M:%S')}"
+    else:
+        text = f"🕐 Atualizado em {snap['updated'].strftime('%d/%m/%Y as %H:%M:%S')}"
+    if tag == version:
+        return dash.no_update, text, dash.no_update, dash.no_update
+    return snap['df'].to_dict('records'), text, tag, FETCH_POLL_MS
 
 
 @app.callback(Output('alerts-container', 'children'), Input('data', 'data'))
@@ -668,6 +1932,56 @@ def update_alerts(data):
     ]
 
 
+@app.callback(Output('evolution-chart', 'figure'), Input('evolution-update', 'n_intervals'))
+def update_evolution(n):
+    with history_lock:
+        load_daily_history()
+        days = sorted(daily_history['days'].items())
+
+    if not days:
+        return go.Figure().update_layout(
+            title='Sem historico ainda (gravado a cada atualizacao de cotacoes)',
+            paper_bgcolor='#1e1e1e',
+            plot_bgcolor='#1e1e1e',
+            font=dict(color='#e0e0e0')
+        )
+
+    dates = [day for day, _ in days]
+    pnl = [agg['pnl'] for _, agg in days]
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.65, 0.35], vertical_spacing=0.06,
+                        subplot_titles=('Valor da Carteira (R$)', 'Ganho/Perda Total (R$)'))
+    fig.add_trace(go.Candlestick(
+        x=dates,
+        open=[agg['open'] for _, agg in days],
+        high=[agg['high'] for _, agg in days],
+        low=[agg['low'] for _, agg in days],
+        close=[agg['close'] for _, agg in days],
+        increasing_line_color='#66bb6a',
+        decreasing_line_color='#f44336',
+        name='Valor'
+    ), row=1, col=1)
+    fig.add_trace(go.Bar(
+        x=dates,
+        y=pnl,
+        marker_color=['#66bb6a' if v >= 0 else '#f44336' for v in pnl],
+        name='P&L'
+    ), row=2, col=1)
+
+    fig.update_layout(
+        paper_bgcolor='#1e1e1e',
+        plot_bgcolor='#263238',
+        font=dict(color='#e0e0e0'),
+        height=700,
+        showlegend=False,
+        xaxis_rangeslider_visible=False,
+        margin=dict(t=40, l=70, r=20, b=40),
+        hovermode='x unified'
+    )
+    fig.update_xaxes(gridcolor='#37474f')
+    fig.update_yaxes(gridcolor='#37474f', tickprefix='R$ ')
+    return fig
+
+
 @app.callback(Output('log-display', 'children'), Input('log-update', 'n_intervals'))
 def update_log(n):
     if not log_queue:
@@ -695,10 +2009,11 @@ def update_log(n):
 
 @app.callback(
     Output('validation-warning', 'children'),
-    [Input('switch-daily', 'value'), Input('switch-weekly', 'value'), Input('switch-monthly', 'value')]
+    [Input('switch-daily', 'value'), Input('switch-weekly', 'value'), Input('switch-monthly', 'value'),
+     Input('switch-risk', 'value'), Input('switch-market', 'value')]
 )
-def validate_switches(daily, weekly, monthly):
-    if not daily and not weekly and not monthly:
+def validate_switches(daily, weekly, monthly, risk, market):
+    if not daily and not weekly and not monthly and not risk and not market:
         return html.Div('⚠️ Pelo menos uma tela deve estar habilitada!', style={'color': '#f44336'})
     return ''
 
@@ -708,28 +2023,36 @@ def validate_switches(daily, weekly, monthly):
      Output('time-message', 'children'), Output('time-message', 'style')],
     Input('btn-save-times', 'n_clicks'),
     [State('input-time-daily', 'value'), State('input-time-weekly', 'value'), 
-     State('input-time-monthly', 'value'), State('switch-daily', 'value'),
-     State('switch-weekly', 'value'), State('switch-monthly', 'value')],
+     State('input-time-monthly', 'value'), State('input-time-risk', 'value'),
+     State('input-time-market', 'value'),
+     State('switch-daily', 'value'), State('switch-weekly', 'value'),
+     State('switch-monthly', 'value'), State('switch-risk', 'value'),
+     State('switch-market', 'value')],
     prevent_initial_call=True
 )
-def save_time_settings(n_clicks, daily, weekly, monthly, daily_enabled, weekly_enabled, monthly_enabled):
+def save_time_settings(n_clicks, daily, weekly, monthly, risk, market,
+                       daily_enabled, weekly_enabled, monthly_enabled, risk_enabled, market_enabled):
     if n_clicks == 0:
         return DEFAULT_TIMES, DEFAULT_ENABLED, '', {}
 
     # Validacao: pelo menos uma tela deve estar habilitada
-    if not daily_enabled and not weekly_enabled and not monthly_enabled:
+    if not daily_enabled and not weekly_enabled and not monthly_enabled and not risk_enabled and not market_enabled:
         return dash.no_update, dash.no_update, '⚠️ Pelo menos uma tela deve estar habilitada!', {'color': '#f44336', 'margin-top': '10px'}
 
     new_settings = {
         'daily': daily or DEFAULT_TIMES['daily'],
         'weekly': weekly or DEFAULT_TIMES['weekly'],
-        'monthly': monthly or DEFAULT_TIMES['monthly']
+        'monthly': monthly or DEFAULT_TIMES['monthly'],
+        'risk': risk or DEFAULT_TIMES['risk'],
+        'market': market or DEFAULT_TIMES['market']
     }
 
     new_enabled = {
         'daily': daily_enabled,
         'weekly': weekly_enabled,
-        'monthly': monthly_enabled
+        'monthly': monthly_enabled,
+        'risk': risk_enabled,
+        'market': market_enabled
     }
 
     enabled_screens = []
@@ -739,6 +2062,10 @@ def save_time_settings(n_clicks, daily, weekly, monthly, daily_enabled, weekly_e
         enabled_screens.append(f"Semanal ({weekly}s)")
     if monthly_enabled:
         enabled_screens.append(f"Mensal ({monthly}s)")
+    if risk_enabled:
+        enabled_screens.append(f"Risco ({risk}s)")
+    if market_enabled:
+        enabled_screens.append(f"Mercado ({market}s)")
 
     screens_text = ", ".join(enabled_screens)
     add_log(f"Configuracoes atualizadas: {screens_text}", 'success')
@@ -748,8 +2075,11 @@ def save_time_settings(n_clicks, daily, weekly, monthly, daily_enabled, weekly_e
 
 @app.callback(
     [Output('input-time-daily', 'value'), Output('input-time-weekly', 'value'), 
-     Output('input-time-monthly', 'value'), Output('switch-daily', 'value'),
-     Output('switch-weekly', 'value'), Output('switch-monthly', 'value')],
+     Output('input-time-monthly', 'value'), Output('input-time-risk', 'value'),
+     Output('input-time-market', 'value'),
+     Output('switch-daily', 'value'), Output('switch-weekly', 'value'),
+     Output('switch-monthly', 'value'), Output('switch-risk', 'value'),
+     Output('switch-market', 'value')],
     Input('url', 'pathname'),
     [State('time-settings', 'data'), State('enabled-settings', 'data')]
 )
@@ -759,13 +2089,32 @@ def load_time_settings(pathname, settings, enabled):
             settings.get('daily', DEFAULT_TIMES['daily']),
             settings.get('weekly', DEFAULT_TIMES['weekly']),
             settings.get('monthly', DEFAULT_TIMES['monthly']),
+            settings.get('risk', DEFAULT_TIMES['risk']),
+            settings.get('market', DEFAULT_TIMES['market']),
             enabled.get('daily', DEFAULT_ENABLED['daily']),
             enabled.get('weekly', DEFAULT_ENABLED['weekly']),
-            enabled.get('monthly', DEFAULT_ENABLED['monthly'])
+            enabled.get('monthly', DEFAULT_ENABLED['monthly']),
+            enabled.get('risk', DEFAULT_ENABLED['risk']),
+            enabled.get('market', DEFAULT_ENABLED['market'])
         )
     return dash.no_update
 
 
+def view_pending(view):
+    """Tela de risco ou mercado ainda no aviso de carregamento (primeiro resultado em calculo)"""
+    # Com um resultado na tela, a atualizacao em segundo plano aparece na proxima volta da rotacao
+    if view == 3:
+        with snapshot_lock:
+            version = snapshot['version'] if snapshot['df'] is not None else None
+        with risk_lock:
+            return risk_cache['result'] is None and (
+                risk_cache['running'] or (version is not None and risk_cache['version'] != version))
+    if view in (4, 5):
+        with market_lock:
+            return market['quotes'] is None
+    return False
+
+
 @app.callback(
     Output('view', 'data'), 
     [Input('rotate', 'n_intervals')], 
@@ -774,6 +2123,9 @@ def load_time_settings(pathname, settings, enabled):
 def rotate(n, current_view, settings, enabled):
     rotation_map = build_rotation_map(settings, enabled)
     index = n % len(rotation_map)
+    # Mesma tela: nao reenvia a figura a cada 5 segundos, exceto risco/mercado ainda em calculo
+    if rotation_map[index] == current_view and not view_pending(current_view):
+        return dash.no_update
     return rotation_map[index]
 
 
@@ -806,36 +2158,85 @@ def update_countdown(n, settings, enabled):
     return f"⏱️ {remaining}s"
 
 
-@app.callback(Output('treemap', 'figure'), [Input('data', 'data'), Input('view', 'data')])
-def update_display(data, view_idx):
+@app.callback(Output('treemap', 'figure'), [Input('data', 'data'), Input('view', 'data')],
+              State('data-version', 'data'))
+def update_display(data, view_idx, version):
     if data is None:
         return go.Figure()
-    df = pd.DataFrame(data)
+    if view_idx == 3:
+        return create_risk_figure()
+    if view_idx in (4, 5):
+        return create_market_treemap('day' if view_idx == 4 else '7days')
     views = ['day', '7days', 'total']
-    return create_treemap(df, views[view_idx] if view_idx is not None else 'day')
+    view_type = views[view_idx] if view_idx is not None else 'day'
+    # Todos os navegadores no snapshot atual compartilham a figura, montada com os dados do servidor
+    # (nunca com os enviados pelo navegador); versao antiga ou desconhecida nao entra no cache
+    snap = get_snapshot()
+    if snap['df'] is None or version != snapshot_tag(snap):
+        return create_treemap(pd.DataFrame(data), view_type)
+    with figure_cache_lock:
+        fig = figure_cache.get((version, view_type))
+    if fig is None:
+        fig = create_treemap(snap['df'], view_type)
+        with figure_cache_lock:
+            for old in [k for k in figure_cache if k[0] != version]:
+                figure_cache.pop(old, None)
+            figure_cache[(version, view_type)] = fig
+    return fig
 
 
 @app.callback(
-    [Output("modal", "is_open"), Output("modal-title", "children"), Output("historical-chart", "figure")],
-    [Input("treemap", "clickData"), Input("close-modal", "n_clicks")],
-    [State("modal", "is_open")]
+    [Output("modal", "is_open"), Output("modal-title", "children"),
+     Output("historical-chart", "figure", allow_duplicate=True),
+     Output("hist-ticker", "data"), Output("hist-range", "value")],
+    [Input("treemap", "clickData"), Input("close-modal", "n_clicks"), Input("modal", "is_open")],
+    prevent_initial_call=True
 )
 def toggle_modal(clickData, close_clicks, is_open):
     ctx = callback_context
-
-    if not ctx.triggered:
-        return False, "", go.Figure()
-
     trigger_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
-    if trigger_id == "treemap" and clickData:
+    # Fechado pelo x do cabecalho, clique fora ou Esc: o navegador ja fechou, falta limpar o ticker
+    # (o que cancela o job em andamento)
+    if trigger_id == "modal":
+        if is_open:
+            raise PreventUpdate
+        return dash.no_update, "", go.Figure(), None, '1mo'
+
+    # Abre o modal na hora; o grafico chega depois pelo callback em segundo plano
+    # Cliques na tela de risco (heatmap) nao tem label de ticker
+    if trigger_id == "treemap" and clickData and 'label' in clickData['points'][0]:
         ticker = clickData['points'][0]['label']
-        return True, f"📈 Historico - {ticker}", get_historical_chart(ticker)
+        loading = go.Figure().update_layout(
+            title='Carregando...',
+            paper_bgcolor='#1e1e1e',
+            plot_bgcolor='#1e1e1e',
+            font=dict(color='#e0e0e0'),
+            height=400
+        )
+        return True, f"📈 Historico - {ticker}", loading, ticker, '1mo'
 
-    if trigger_id == "close-modal":
-        return False, "", go.Figure()
+    if trigger_id == "treemap":
+        raise PreventUpdate
 
-    return is_open, "", go.Figure()
+    return False, "", go.Figure(), None, '1mo'
+
+
+@app.callback(
+    Output("historical-chart", "figure"),
+    [Input("hist-ticker", "data"), Input("hist-range", "value")],
+    background=True,
+    running=[(Output("hist-loading", "style"),
+              {'display': 'inline', 'color': '#78909c', 'margin-left': '15px'}, {'display': 'none'})],
+    cancel=[Input("close-modal", "n_clicks")],
+    interval=500,
+    prevent_initial_call=True
+)
+def load_historical_chart(ticker, period):
+    # Clicar em outro ticker ou trocar o periodo cancela o job anterior (oldJob do Dash)
+    if not ticker:
+        return go.Figure()
+    return get_historical_chart(ticker, period)
 
 
 @app.callback(
@@ -882,88 +2283,273 @@ def add_stock(n_clicks, ticker, shares, price, trigger):
 
 
 @app.callback(
-    [Output('stocks-table', 'children'), Output('delete-message', 'children')],
-    [Input('update-trigger', 'data'), Input('url', 'pathname'), Input('delete-trigger', 'children')]
+    [Output('import-message', 'children'), Output('import-message', 'style'),
+     Output('update-trigger', 'data', allow_duplicate=True)],
+    Input('btn-import', 'n_clicks'),
+    [State('input-import-path', 'value'), State('switch-import-reset', 'value'), State('update-trigger', 'data')],
+    prevent_initial_call=True
 )
-def update_table(trigger, pathname, delete_trigger):
+def import_stocks(n_clicks, path, reset, trigger):
+    if not path:
+        return '⚠️ Informe o caminho do arquivo!', {'color': '#f44336', 'margin-top': '10px', 'font-weight': 'bold'}, trigger
+
+    try:
+        positions, summary = import_trades(path.strip(), reset=bool(reset))
+    except (OSError, ValueError, TradeFileError) as e:
+        add_log(f"Erro ao importar {path}: {e}", 'error')
+        return f'❌ Erro: {e}', {'color': '#f44336', 'margin-top': '10px', 'font-weight': 'bold'}, trigger
+
+    for warning in summary['warnings'][:10]:
+        add_log(f"Importacao: {warning}", 'warning')
+
+    # Grava a carteira uma unica vez com todas as posicoes importadas
+    if not save_stocks(merge_positions(load_stocks(), positions)):
+        return '❌ Erro ao salvar!', {'color': '#f44336', 'margin-top': '10px', 'font-weight': 'bold'}, trigger
+
+    add_log(f"Importacao: {summary['rows']} negociacoes novas, {summary['tickers']} tickers", 'success')
+    return (f"✅ {summary['rows']} negociacoes novas processadas ({summary['tickers']} tickers)",
+            {'color': '#66bb6a', 'margin-top': '10px', 'font-weight': 'bold'}, trigger + 1)
+
+
+# Operadores aceitos no filtro da tabela (sintaxe do filter_query do DataTable)
+FILTER_OPERATORS = [
+    ['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'],
+    ['ne ', '!='], ['eq ', '='], ['contains '], ['datestartswith ']
+]
+
+
+def split_filter_part(filter_part):
+    """Separa uma clausula do filter_query em (coluna, operador, valor)"""
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ''
+                if v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return [None] * 3
+
+
+def query_stocks(df, sort_by, filter_query):
+    """Aplica filtro e ordenacao do DataTable no servidor"""
+    for part in (filter_query or '').split(' && '):
+        col_name, operator, value = split_filter_part(part)
+        if col_name not in df.columns:
+            continue
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            # Valor de tipo diferente da coluna ({shares} < abc) seria TypeError: ignora a clausula
+            numeric = pd.api.types.is_numeric_dtype(df[col_name])
+            if numeric != isinstance(value, float):
+                continue
+            if col_name == 'ticker':
+                value = value.upper()
+                # Na tabela os tickers ficam com .SA; o usuario costuma digitar sem
+                if operator in ('eq', 'ne') and not value.endswith('.SA'):
+                    value = f'{value}.SA'
+            df = df.loc[getattr(df[col_name], operator)(value)]
+        elif operator == 'contains':
+            df = df.loc[df[col_name].astype(str).str.contains(str(value), case=False, regex=False)]
+        elif operator == 'datestartswith':
+            df = df.loc[df[col_name].astype(str).str.startswith(str(value))]
+
+    if sort_by:
+        df = df.sort_values(
+            [col['column_id'] for col in sort_by],
+            ascending=[col['direction'] == 'asc' for col in sort_by]
+        )
+    return df
+
+
+@app.callback(
+    [Output('stocks-table', 'data'), Output('stocks-table', 'page_count'), Output('stocks-empty', 'children')],
+    [Input('stocks-table', 'page_current'), Input('stocks-table', 'page_size'),
+     Input('stocks-table', 'sort_by'), Input('stocks-table', 'filter_query'),
+     Input('update-trigger', 'data'), Input('url', 'pathname')]
+)
+def update_table(page_current, page_size, sort_by, filter_query, trigger, pathname):
     df = load_stocks()
 
     if df.empty:
-        return html.P('📭 Nenhuma acao cadastrada.', style={'color': '#78909c', 'font-style': 'italic', 'font-size': '15px'}), ''
-
-    table_rows = []
-    for idx, row in df.iterrows():
-        table_rows.append(
-            html.Tr([
-                html.Td(
-                    row['ticker'],
-                    style={'padding': '15px', 'border-bottom': '1px solid #37474f', 'font-weight': 'bold', 'color': '#66bb6a'}
-                ),
-                html.Td(
-                    f"{row['shares']}",
-                    style={'padding': '15px', 'border-bottom': '1px solid #37474f', 'text-align': 'center', 'color': '#e0e0e0'}
-                ),
-                html.Td(
-                    f"R$ {row['avg_price']:.2f}",
-                    style={'padding': '15px', 'border-bottom': '1px solid #37474f', 'text-align': 'right', 'color': '#e0e0e0'}
-                ),
-                html.Td(
-                    html.Button('🗑️', id={'type': 'delete-btn', 'index': idx}, n_clicks=0, className='delete-btn', style={
-                        'background': '#c62828',
-                        'color': 'white',
-                        'border': 'none',
-                        'padding': '8px 16px',
-                        'border-radius': '6px',
-                        'cursor': 'pointer',
-                        'font-size': '18px'
-                    }),
-                    style={'padding': '15px', 'border-bottom': '1px solid #37474f', 'text-align': 'center'}
-                )
-            ], style={'transition': 'background-color 0.2s ease'})
-        )
+        return [], 1, html.P('📭 Nenhuma acao cadastrada.', style={'color': '#78909c', 'font-style': 'italic', 'font-size': '15px'})
 
-    table = html.Table([
-        html.Thead(html.Tr([
-            html.Th('Ticker', style={'padding': '15px', 'border-bottom': '2px solid #66bb6a', 'text-align': 'left', 'color': '#66bb6a', 'font-size': '16px'}),
-            html.Th('Quantidade', style={'padding': '15px', 'border-bottom': '2px solid #66bb6a', 'text-align': 'center', 'color': '#66bb6a', 'font-size': '16px'}),
-            html.Th('Preco Medio', style={'padding': '15px', 'border-bottom': '2px solid #66bb6a', 'text-align': 'right', 'color': '#66bb6a', 'font-size': '16px'}),
-            html.Th('Acao', style={'padding': '15px', 'border-bottom': '2px solid #66bb6a', 'text-align': 'center', 'color': '#66bb6a', 'font-size': '16px'})
-        ])),
-        html.Tbody(table_rows)
-    ], style={'width': '100%', 'border-collapse': 'collapse', 'background-color': '#1e1e1e'})
+    df = query_stocks(df, sort_by, filter_query)
+    page_current = page_current or 0
+    page_size = page_size or STOCKS_PAGE_SIZE
+    page = df.iloc[page_current * page_size:(page_current + 1) * page_size].copy()
 
-    return table, ''
+    # O ticker e o id da linha: edicao e remocao nao dependem da posicao
+    page['id'] = page['ticker']
+    page_count = max(1, -(-len(df) // page_size))
+    return page.to_dict('records'), page_count, ''
 
 
 @app.callback(
-    Output('delete-trigger', 'children'),
-    Input({'type': 'delete-btn', 'index': dash.dependencies.ALL}, 'n_clicks'),
+    [Output('delete-message', 'children'), Output('update-trigger', 'data', allow_duplicate=True)],
+    Input('stocks-table', 'data_timestamp'),
+    [State('stocks-table', 'data'), State('stocks-table', 'data_previous'), State('update-trigger', 'data')],
     prevent_initial_call=True
 )
-def delete_stock(n_clicks_list):
-    ctx = callback_context
+def edit_stock(timestamp, rows, previous, trigger):
+    if previous is None:
+        return dash.no_update, dash.no_update
 
-    if not ctx.triggered or not any(n_clicks_list):
-        return ''
+    current = {row['id']: row for row in rows}
+    removed = [row['id'] for row in previous if row['id'] not in current]
+    changed = [current[row['id']] for row in previous
+               if row['id'] in current and (row['shares'], row['avg_price']) !=
+               (current[row['id']]['shares'], current[row['id']]['avg_price'])]
 
-    button_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    if not removed and not changed:
+        return dash.no_update, dash.no_update
 
     try:
-        import json
-        button_dict = json.loads(button_id)
-        row_idx = button_dict['index']
-
         df = load_stocks()
-        if row_idx < len(df):
-            ticker = df.iloc[row_idx]['ticker']
-            df = df.drop(row_idx).reset_index(drop=True)
-            save_stocks(df)
-            add_log(f"{ticker} removido", 'info')
-            return f'{ticker} removido'
+        messages = []
+        if removed:
+            df = df[~df['ticker'].isin(removed)]
+            for ticker in removed:
+                add_log(f"{ticker} removido", 'info')
+            messages.append(f"{', '.join(removed)} removido")
+        for row in changed:
+            shares = int(row['shares'])
+            avg_price = float(str(row['avg_price']).replace(',', '.'))
+            df.loc[df['ticker'] == row['id'], ['shares', 'avg_price']] = [shares, avg_price]
+            add_log(f"{row['id']} alterado: {shares} acoes a R$ {avg_price:.2f}", 'info')
+            messages.append(f"{row['id']} alterado")
+        save_stocks(df.reset_index(drop=True))
+        return '✅ ' + '; '.join(messages), trigger + 1
     except Exception as e:
-        add_log(f"Erro ao deletar: {e}", 'error')
-
-    return ''
+        add_log(f"Erro ao editar: {e}", 'error')
+        return f'❌ Erro: {e}', trigger + 1
+
+
+def _timed_callback(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.callback_time = time.perf_counter() - start
+    return wrapper
+
+
+# Mede cada callback registrado (funcao + serializacao JSON feita pelo Dash)
+for _cb in app.callback_map.values():
+    _cb['callback'] = _timed_callback(_cb['callback'])
+
+
+@app.server.before_request
+def start_callback_timer():
+    if request.path != '/_dash-update-component':
+        return
+    g.start = time.perf_counter()
+    # Com o profiler armado, os callbacks sao serializados para um unico cProfile
+    if profiling['remaining'] > 0 and profile_lock.acquire(timeout=30):
+        if profiling['remaining'] > 0:
+            g.profiling = True
+            profiling['profiler'].enable()
+        else:
+            profile_lock.release()
+
+
+@app.server.after_request
+def log_slow_callback(response):
+    if 'start' not in g:
+        return response
+    total = time.perf_counter() - g.start
+    if total * 1000 >= SLOW_CALLBACK_MS:
+        body = request.get_json(silent=True) or {}
+        name = str(body.get('output', '?')).strip('.').replace('...', ', ')
+        callback = g.get('callback_time', total)
+        stages = g.get('stages', [])
+        parts = [f"{stage} {seconds * 1000:.0f}" for stage, seconds in stages]
+        parts.append(f"json/callback {(callback - sum(sec for _, sec in stages)) * 1000:.0f}")
+        parts.append(f"dispatch {(total - callback) * 1000:.0f}")
+        add_log(f"🐢 Callback lento: {name} {total * 1000:.0f} ms ({', '.join(parts)} ms)", 'warning')
+    return response
+
+
+@app.server.after_request
+def cache_versioned_assets(response):
+    if request.path.startswith(app.get_asset_url('')) and 'm' in request.args and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+@app.server.teardown_request
+def stop_callback_profiler(exc):
+    if not g.get('profiling'):
+        return
+    profiler = profiling['profiler']
+    profiler.disable()
+    profiling['remaining'] -= 1
+    if profiling['remaining'] == 0:
+        profiler.dump_stats(PROFILE_FILE)
+        profiling['ready'] = True
+        add_log(f"Perfil de {profiling['total']} callbacks pronto em /debug/profile", 'success')
+    profile_lock.release()
+
+
+def profile_response(path, name):
+    """Arquivo .prof (pstats) ou, com ?formato=texto, as 40 funcoes de maior tempo acumulado"""
+    if request.args.get('formato') == 'texto':
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(40)
+        return Response(out.getvalue(), mimetype='text/plain')
+    return send_file(path, as_attachment=True, download_name=name)
+
+
+@app.server.route('/debug/profile')
+def debug_profile():
+    """?callbacks=N arma o cProfile para os proximos N callbacks; ?refresh=1 perfila uma atualizacao agora;
+    sem parametros baixa o resultado. Exige ?token= igual a PROFILE_TOKEN."""
+    if not PROFILE_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.args.get('token', ''), PROFILE_TOKEN):
+        abort(403)
+
+    if request.args.get('refresh'):
+        with snapshot_lock:
+            if snapshot['running']:
+                return Response('Atualizacao em andamento, tente de novo\n', status=409, mimetype='text/plain')
+            snapshot['running'] = True
+        profiler = cProfile.Profile()
+        profiling['upstream'] = []
+        try:
+            profiler.runcall(refresh_snapshot)
+        finally:
+            profiles, profiling['upstream'] = profiling['upstream'], None
+        stats = pstats.Stats(profiler)
+        for upstream_profiler in profiles:
+            stats.add(upstream_profiler)
+        stats.dump_stats(PROFILE_REFRESH_FILE)
+        add_log("Atualizacao perfilada via /debug/profile", 'info')
+        return profile_response(PROFILE_REFRESH_FILE, 'refresh.prof')
+
+    count = request.args.get('callbacks', type=int)
+    if count:
+        with profile_lock:
+            profiling.update(profiler=cProfile.Profile(), remaining=count, total=count, ready=False)
+        add_log(f"Profiler armado para os proximos {count} callbacks", 'info')
+        return Response(f'Perfilando os proximos {count} callbacks\n', status=202, mimetype='text/plain')
+
+    if profiling['ready']:
+        return profile_response(PROFILE_FILE, 'callbacks.prof')
+    if profiling['remaining'] > 0:
+        return Response(f"Faltam {profiling['remaining']} de {profiling['total']} callbacks\n", status=202, mimetype='text/plain')
+    return Response('Nenhum perfil coletado (use ?callbacks=N ou ?refresh=1)\n', status=404, mimetype='text/plain')
 
 
 if __name__ == '__main__':
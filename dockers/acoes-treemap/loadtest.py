@@ -0,0 +1,358 @@
+"""Teste de carga offline do dashboard.
+
+Sobe a aplicacao em um subprocesso com uma fonte de cotacoes falsa (sem acesso
+ao Yahoo) e simula N navegadores repetindo o trafego real de
+`_dash-update-component` de cada tipo de cliente:
+
+- quiosque: contador de 1 s, rotacao de 5 s (+ redesenho do treemap) e consulta de dados a cada 30 s
+  (2 s enquanto a primeira busca nao termina)
+- editor: abre /editar (configuracoes e tabela de acoes) e recarrega a pagina
+- logs: consulta a cada 2 s
+
+Para cada N informado, reporta latencia p50/p99 por callback, vazao e
+CPU/memoria do processo servidor.
+
+Uso:
+    python loadtest.py --clients 5,20,50 --duration 30
+    python loadtest.py --clients 100 --mix kiosk=0.9,logs=0.1 --speed 5
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_TIMES = {'daily': 20, 'weekly': 10, 'monthly': 10}
+DEFAULT_ENABLED = {'daily': True, 'weekly': True, 'monthly': True}
+
+
+# ---------------------------------------------------------------- servidor
+
+def serve(port, positions, latency):
+    """Roda a aplicacao com cotacoes falsas e deterministicas (modo subprocesso)"""
+    import numpy as np
+    import pandas as pd
+
+    workdir = tempfile.mkdtemp(prefix='acoes-loadtest-')
+    rng = random.Random(42)
+    with open(os.path.join(workdir, 'acoes.csv'), 'w') as f:
+        f.write('ticker,shares,avg_price\n')
+        for i in range(positions):
+            f.write(f'T{i:03d}3.SA,{rng.randint(1, 20) * 100},{rng.uniform(5, 50):.2f}\n')
+    os.chdir(workdir)
+
+    sys.path.insert(0, os.path.join(HERE, 'app'))
+    import main
+
+    class FakeTicker:
+        """Substitui yf.Ticker: serie aleatoria estavel por ticker, com latencia configuravel"""
+
+        def __init__(self, ticker, session=None):
+            self.ticker = ticker
+
+        def history(self, period='10d', **kwargs):
+            time.sleep(latency)
+            n = {'10d': 10, '1mo': 22, '1y': 250, '5y': 1250, 'max': 5000}.get(period, 10)
+            gen = np.random.default_rng(sum(map(ord, self.ticker)))
+            idx = pd.date_range(end=pd.Timestamp.today().normalize(), periods=n, freq='B')
+            return pd.DataFrame({'Close': 20 + np.cumsum(gen.normal(0, 0.3, n))}, index=idx)
+
+    main.yf.Ticker = FakeTicker
+
+    from werkzeug.serving import make_server
+    make_server('127.0.0.1', port, main.app.server, threaded=True).serve_forever()
+
+
+# ---------------------------------------------------------------- clientes
+
+def dash_payload(outputs, inputs, state=(), changed=None):
+    """Monta o corpo de uma requisicao `_dash-update-component` como o renderer do Dash"""
+    outs = [{'id': i, 'property': p} for i, p in outputs]
+    if len(outs) == 1:
+        output = f'{outputs[0][0]}.{outputs[0][1]}'
+        outs = outs[0]
+    else:
+        output = '..' + '...'.join(f'{i}.{p}' for i, p in outputs) + '..'
+    body = {
+        'output': output,
+        'outputs': outs,
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'changedPropIds': [changed or f'{inputs[0][0]}.{inputs[0][1]}'],
+    }
+    if state:
+        body['state'] = [{'id': i, 'property': p, 'value': v} for i, p, v in state]
+    return body
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.bytes = 0
+        self.errors = 0
+
+    def record(self, name, seconds, size, ok):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.bytes += size
+            if not ok:
+                self.errors += 1
+
+
+class Client(threading.Thread):
+    """Um navegador simulado; cada tick equivale a 1 s de relogio (dividido por --speed)"""
+
+    def __init__(self, kind, base_url, stats, stop, speed):
+        super().__init__(daemon=True)
+        self.kind = kind
+        self.base_url = base_url
+        self.stats = stats
+        self.stop = stop
+        self.tick = 1.0 / speed
+        self.data = None
+        self.version = None
+        self.view = 0
+        self.fetch_every = 2
+
+    def call(self, name, body):
+        req = urllib.request.Request(
+            self.base_url + '/_dash-update-component',
+            data=json.dumps(body).encode(),
+            headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=60) as resp:
+                raw = resp.read()
+                status = resp.status
+                encoding = resp.headers.get('Content-Encoding')
+        except urllib.error.HTTPError as e:
+            raw, status, encoding = e.read(), e.code, None
+        except Exception:
+            self.stats.record(name, time.perf_counter() - start, 0, False)
+            return None
+        self.stats.record(name, time.perf_counter() - start, len(raw), status in (200, 204))
+        if status != 200:
+            return None
+        if encoding == 'gzip':
+            raw = gzip.decompress(raw)
+        return json.loads(raw).get('response')
+
+    def page(self, pathname):
+        self.call('display_page', dash_payload([('page-content', 'children')], [('url', 'pathname', pathname)]))
+
+    def fetch(self, n):
+        resp = self.call('update_data', dash_payload(
+            [('data', 'data'), ('time', 'children'), ('data-version', 'data'), ('fetch', 'interval')],
+            [('fetch', 'n_intervals', n)], [('data-version', 'data', self.version)]))
+        if resp and 'fetch' in resp:
+            self.fetch_every = max(1, resp['fetch']['interval'] // 1000)
+        # Snapshot igual ao que o cliente ja tem (ou ainda sem dados): nada de novo para desenhar
+        if not resp or 'data' not in resp or resp['data']['data'] is None:
+            return
+        self.data = resp['data']['data']
+        self.version = resp['data-version']['data']
+        self.call('update_alerts', dash_payload([('alerts-container', 'children')], [('data', 'data', self.data)]))
+        self.display()
+
+    def display(self):
+        self.call('update_display', dash_payload(
+            [('treemap', 'figure')], [('data', 'data', self.data), ('view', 'data', self.view)],
+            [('data-version', 'data', self.version)]))
+
+    def run_kiosk(self):
+        self.page('/')
+        settings = [('time-settings', 'data', DEFAULT_TIMES), ('enabled-settings', 'data', DEFAULT_ENABLED)]
+        n = fetches = next_fetch = 0
+        while not self.stop.is_set():
+            if n >= next_fetch:
+                self.fetch(fetches)
+                fetches += 1
+                next_fetch = n + self.fetch_every
+            self.call('update_countdown', dash_payload(
+                [('countdown', 'children')], [('countdown-timer', 'n_intervals', n)], settings))
+            if n % 5 == 0 and n:
+                resp = self.call('rotate', dash_payload(
+                    [('view', 'data')], [('rotate', 'n_intervals', n // 5)],
+                    [('view', 'data', self.view)] + settings))
+                if resp and resp['view']['data'] != self.view:
+                    self.view = resp['view']['data']
+                    self.display()
+            n += 1
+            self.stop.wait(self.tick)
+
+    def run_editor(self):
+        settings = [('time-settings', 'data', DEFAULT_TIMES), ('enabled-settings', 'data', DEFAULT_ENABLED)]
+        while not self.stop.is_set():
+            self.page('/editar')
+            self.call('load_time_settings', dash_payload(
+                [('input-time-daily', 'value'), ('input-time-weekly', 'value'), ('input-time-monthly', 'value'),
+                 ('input-time-risk', 'value'), ('input-time-market', 'value'),
+                 ('switch-daily', 'value'), ('switch-weekly', 'value'), ('switch-monthly', 'value'),
+                 ('switch-risk', 'value'), ('switch-market', 'value')],
+                [('url', 'pathname', '/editar')], settings))
+            # Usuario navega por algumas paginas da tabela antes de recarregar
+            for page in range(3):
+                self.call('update_table', dash_payload(
+                    [('stocks-table', 'data'), ('stocks-table', 'page_count'), ('stocks-empty', 'children')],
+                    [('stocks-table', 'page_current', page), ('stocks-table', 'page_size', 25),
+                     ('stocks-table', 'sort_by', []), ('stocks-table', 'filter_query', ''),
+                     ('update-trigger', 'data', 0), ('url', 'pathname', '/editar')]))
+                self.stop.wait(10 * self.tick)
+
+    def run_logs(self):
+        self.page('/logs')
+        n = 0
+        while not self.stop.is_set():
+            self.call('update_log', dash_payload([('log-display', 'children')], [('log-update', 'n_intervals', n)]))
+            n += 1
+            self.stop.wait(2 * self.tick)
+
+    def run(self):
+        # Espalha o inicio dos clientes dentro do primeiro segundo
+        self.stop.wait(random.random() * self.tick)
+        getattr(self, f'run_{self.kind}')()
+
+
+# ---------------------------------------------------------------- medicao
+
+def proc_sample(pid):
+    """(segundos de CPU, RSS em MB) do processo via /proc; None fora do Linux"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS'))
+        return cpu, rss / 1024
+    except (OSError, StopIteration, IndexError):
+        return None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def allocate(n, mix):
+    """Divide N clientes pela proporcao (maior resto); cada tipo com proporcao > 0 tem pelo menos um, se N permitir"""
+    total = sum(mix.values())
+    quotas = {kind: n * share / total for kind, share in mix.items()}
+    minimum = 1 if n >= sum(1 for share in mix.values() if share > 0) else 0
+    counts = {kind: max(int(q), minimum if mix[kind] > 0 else 0) for kind, q in quotas.items()}
+    # Sobrou: vai para os maiores restos; passou (pelos minimos): sai de quem esta mais acima da cota
+    while sum(counts.values()) < n:
+        counts[max(counts, key=lambda k: quotas[k] - counts[k])] += 1
+    while sum(counts.values()) > n:
+        counts[max((k for k in counts if counts[k] > minimum), key=lambda k: counts[k] - quotas[k])] -= 1
+    return [kind for kind, count in counts.items() for _ in range(count)]
+
+
+def run_step(base_url, pid, n, mix, duration, speed):
+    kinds = allocate(n, mix)
+
+    stats = Stats()
+    stop = threading.Event()
+    clients = [Client(kind, base_url, stats, stop, speed) for kind in kinds]
+
+    before = proc_sample(pid)
+    peak_rss = before[1] if before else 0
+    start = time.perf_counter()
+    for c in clients:
+        c.start()
+    while time.perf_counter() - start < duration:
+        time.sleep(0.5)
+        sample = proc_sample(pid)
+        if sample:
+            peak_rss = max(peak_rss, sample[1])
+    stop.set()
+    for c in clients:
+        c.join(timeout=60)
+    elapsed = time.perf_counter() - start
+    after = proc_sample(pid)
+
+    total = sum(len(v) for v in stats.latencies.values())
+    every = [x for v in stats.latencies.values() for x in v]
+    print(f'\n=== N={n} ({", ".join(f"{k}={kinds.count(k)}" for k in mix)}) '
+          f'{total} requisicoes em {elapsed:.1f}s ===')
+    print(f'{"callback":<20}{"qtd":>8}{"p50 ms":>10}{"p99 ms":>10}')
+    for name, values in sorted(stats.latencies.items()):
+        print(f'{name:<20}{len(values):>8}{percentile(values, 50) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}')
+    if every:
+        print(f'{"(todos)":<20}{total:>8}{percentile(every, 50) * 1000:>10.1f}{percentile(every, 99) * 1000:>10.1f}')
+    print(f'vazao: {total / elapsed:.1f} req/s   {stats.bytes / elapsed / 1024:.0f} KB/s   erros: {stats.errors}')
+    if before and after:
+        print(f'CPU servidor: {(after[0] - before[0]) / elapsed * 100:.0f}% de um nucleo   '
+              f'RSS: {after[1]:.0f} MB (pico {peak_rss:.0f} MB)')
+
+
+def wait_ready(base_url, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            sys.exit('servidor encerrou durante a inicializacao')
+        try:
+            urllib.request.urlopen(base_url + '/_dash-layout', timeout=2).read()
+            return
+        except Exception:
+            time.sleep(0.3)
+    sys.exit('servidor nao respondeu a tempo')
+
+
+def warm_up(base_url, timeout=300):
+    """Espera a primeira busca de cotacoes terminar, para ela nao entrar nas medidas da primeira etapa"""
+    client = Client('kiosk', base_url, Stats(), threading.Event(), 1)
+    deadline = time.time() + timeout
+    n = 0
+    while client.data is None:
+        if time.time() > deadline:
+            sys.exit('primeira busca de cotacoes nao terminou a tempo')
+        client.fetch(n)
+        n += 1
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga offline do Mapa de Acoes')
+    parser.add_argument('--clients', default='5,20,50', help='lista de N clientes simultaneos (ex: 5,20,50)')
+    parser.add_argument('--mix', default='kiosk=0.8,editor=0.1,logs=0.1', help='proporcao de cada tipo de cliente')
+    parser.add_argument('--duration', type=float, default=30, help='segundos por etapa')
+    parser.add_argument('--speed', type=float, default=1, help='acelera os intervalos dos clientes (2 = dobro)')
+    parser.add_argument('--positions', type=int, default=30, help='acoes na carteira falsa')
+    parser.add_argument('--latency', type=float, default=0.05, help='latencia simulada do Yahoo por chamada (s)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.positions, args.latency)
+        return
+
+    mix = {k: float(v) for k, v in (item.split('=') for item in args.mix.split(','))}
+    base_url = f'http://127.0.0.1:{args.port}'
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port),
+         '--positions', str(args.positions), '--latency', str(args.latency)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_ready(base_url, proc)
+        warm_up(base_url)
+        for n in (int(x) for x in args.clients.split(',')):
+            run_step(base_url, proc.pid, n, mix, args.duration, args.speed)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Mede o custo de conexao com o Yahoo (TCP + TLS) em uma atualizacao completa da carteira.
+
+Busca o historico de 10 dias de todos os tickers do acoes.csv:
+
+- thread nova: como antes, a atualizacao rodava na thread da requisicao HTTP
+  (nova a cada vez) e o curl_cffi abre uma conexao por thread
+- pool: pelo upstream_call do servidor, nas threads fixas com conexoes keep-alive;
+  a partir da segunda rodada as conexoes ja estao abertas
+
+Usa o limitador do servidor (2 requisicoes/s) e precisa de acesso ao Yahoo. Com --url, cada ticker
+vira um GET na URL dada (servidor HTTPS local, por exemplo), para medir sem acesso ao Yahoo.
+
+Uso:
+    python medir_conexoes.py
+    python medir_conexoes.py --rodadas 3 --intervalo 290   # intervalo real entre atualizacoes
+    python medir_conexoes.py --url https://localhost:8443/ --ca cert.pem
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(main, name, run):
+    main.upstream_session.take_stats()
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    stats = main.upstream_session.take_stats()
+    per_request = stats['handshake'] * 1000 / stats['requests'] if stats['requests'] else 0
+    print(f"{name:<22} {stats['requests']:>5} {stats['connects']:>8} {stats['handshake'] * 1000:>12.0f}"
+          f" {per_request:>10.1f} {elapsed:>9.1f}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mede conexoes novas e handshake por atualizacao')
+    parser.add_argument('--carteira', default=os.path.join(HERE, 'acoes.csv'), help='arquivo da carteira')
+    parser.add_argument('--rodadas', type=int, default=2, help='atualizacoes pelo pool')
+    parser.add_argument('--intervalo', type=float, default=0, help='segundos entre as atualizacoes pelo pool')
+    parser.add_argument('--url', help='mede com GETs nesta URL em vez do Yahoo')
+    parser.add_argument('--ca', help='certificado da CA da --url (servidor local autoassinado)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(HERE, 'app'))
+    import main as app_main
+    import pandas as pd
+
+    tickers = pd.read_csv(args.carteira)['ticker'].tolist()
+    print(f"{len(tickers)} tickers\n")
+    print(f"{'modo':<22} {'req.':>5} {'conexoes':>8} {'TCP/TLS ms':>12} {'ms/req.':>10} {'total s':>9}")
+
+    if args.url:
+        app_main.renew_upstream_auth = lambda: None
+        history = lambda ticker, period: app_main.upstream_call(
+            lambda: app_main.upstream_session.get(args.url, verify=args.ca or True))
+    else:
+        history = app_main.upstream_history
+
+    def fresh_thread():
+        def fetch():
+            # Mesmo limitador do pool, mas na conexao propria desta thread
+            app_main.upstream_session.local.limiters = (app_main.upstream_limiter,)
+            for ticker in tickers:
+                if args.url:
+                    app_main.upstream_session.get(args.url, verify=args.ca or True)
+                else:
+                    app_main.yf.Ticker(ticker, session=app_main.upstream_session).history(period='10d')
+        worker = threading.Thread(target=fetch)
+        worker.start()
+        worker.join()
+
+    def pooled():
+        for ticker in tickers:
+            history(ticker, '10d')
+
+    # Cookie e crumb ficam em cache no processo (como no servidor ja em execucao); nao entram na medida
+    warmup = threading.Thread(target=lambda: history(tickers[0], '1d'))
+    warmup.start()
+    warmup.join()
+
+    before = measure(app_main, 'thread nova', fresh_thread)
+    after = None
+    for i in range(args.rodadas):
+        if i and args.intervalo:
+            time.sleep(args.intervalo)
+        after = measure(app_main, f'pool (rodada {i + 1})', pooled)
+
+    if before['requests'] and after and after['requests']:
+        saved = (before['handshake'] / before['requests'] - after['handshake'] / after['requests']) * 1000
+        print(f"\neconomia por requisicao na ultima rodada: {saved:.1f} ms de TCP/TLS "
+              f"({before['connects'] - after['connects']} conexoes a menos)")
+
+
+if __name__ == '__main__':
+    main()